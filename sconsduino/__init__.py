@@ -1,35 +1,133 @@
 from __future__ import absolute_import
 import os.path
+import re
+import sys
+import stat
 import glob
+import subprocess
+from . import cache
+from . import size
+from . import scan
+from . import libindex
+from . import depfile
+from . import unity
+from . import distcc
+from . import elf as elffile
+from . import history
+from . import stack
+from . import cycles
+from . import stk500
+from . import farm
+from . import devices
 
 ARDUINO_VER = 106
 
+# First GCC with a usable -flto and gcc-ar
+LTO_MIN_GCC = (4, 7)
+# First GCC with -fstack-usage
+STACK_USAGE_MIN_GCC = (4, 6)
+# First GCC with -Og, and what the debug profile uses before that
+OG_MIN_GCC = (4, 8)
+DEBUG_FALLBACK = ['-O1']
+
+PROFILES = {
+	'size': ['-Os'],
+	'balanced': ['-O2'],
+	'speed': ['-O3'],
+	'debug': ['-Og'],
+}
+DEFAULT_PROFILE = 'size'
+
+# What _variant() names look like
+VARIANT = re.compile(r'^\w+-[0-9a-f]{8}$')
+
+def _pch_stub(target, source, env):
+	"""
+	SCons action: a header that includes source[0], to stand next to its .gch.
+	"""
+	with open(str(target[0]), 'w') as f:
+		f.write('#include "{}"\n'.format(source[0].get_abspath()))
+
 class Arduino(object):
-	def __init__(self, env, src_dir='.', build_dir='.', **kw):
+	# Core headers to precompile
+	PCH_HEADERS = ['Arduino.h']
+	# Sources (by basename) to leave out of unity builds
+	UNITY_UNSAFE = []
+	# Images made from the linked ELF; the first is what gets uploaded
+	IMAGES = ['.hex', '.eep']
+	# (vid, pid) of what the board shows up as over USB, to find it with
+	USB_IDS = []
+	# Where to upload if nothing's configured or found
+	DEFAULT_SERIAL_PORT = None
+
+	def __init__(self, env, src_dir='.', build_dir='.', core_cache=True, lto=False, depfiles=False, pch=False, unity=None, object_cache=True, **kw):
 		self.env = env
 		self.objects = []
+		self.sources = []
+		self.core_cache = core_cache
+		self._lto = lto
+		self._depfiles = depfiles
+		self._pch = pch
+		self._pch_nodes = []
+		self._core_pchflags = []
+		self._unity = unity
+		self.object_cache = object_cache
+		self._distcc_hosts = []
+		self._unity_exclude = set(self.UNITY_UNSAFE)
+		self._prepared = False
+		self._tools = None
+		self._libs = []
+		self._added = []
+		self._auto_libs = False
+		self.variant_dir = None
+		self._core = None
+		self._core_objects = None
+		self._core_sources = None
+		self._runtimes = []
+		self._runtime_objects = None
+		self._reports = []
 		self._load_config()
 		self.build_dir = self.env.Dir(build_dir)
 		self.src_dir = self.env.Dir(src_dir)
+		# Where objects go in build_dir, by where their sources come from
+		self._roots = [('sketch', self.src_dir), ('gen', self.build_dir)]
 		self.env.Append(
 			ARDUINO=self.config['ARDUINO_DIR'],
 			CPPPATH = [self.src_dir],
 			CPPDEFINES = {'ARDUINO': ARDUINO_VER},
 			# C/C++
-			CCFLAGS=['-g', '-Os', '-Wall', '-ffunction-sections', '-fdata-sections'], # Arduino also has -MMD, for reasons unknown to me
+			OPTFLAGS=PROFILES[DEFAULT_PROFILE],
+			CCFLAGS=['-g', '$OPTFLAGS', '-Wall', '-ffunction-sections', '-fdata-sections'], # Arduino also has -MMD, for reasons unknown to me
 			# C only
 			CFLAGS=[],
 			# C++ only
-			CXXFLAGS=['-fno-exceptions', '-fno-rtti', '-felide-constructors'],
-			LINKFLAGS=['-Os', '-Wl,--gc-sections', '-L'+str(self.build_dir)],
+			CXXFLAGS=['-fno-exceptions', '-fno-rtti', '-felide-constructors', '$PCHFLAGS'],
+			PCHFLAGS=[],
+			LINKFLAGS=['$OPTFLAGS', '-Wl,--gc-sections', '-L'+str(self.build_dir)],
 		)
 		self.env.Replace(
-			LINK='$CC'
+			LINK='$CC',
+			# Found when an upload runs, not when the SConstruct is read
+			SERIAL_PORT=self._upload_port,
 		)
-		
+		self._profile = DEFAULT_PROFILE
+		self.profile_report = False
+		self._og = None
+		self._budget = {}
+		self._size_history = True
+		self._size_history_top = history.TOP
+		self._stack_usage = False
+		self._cycles = None
+		self._stk500 = None
+		self._farm = {}
+		self._usb_ids = []
+		self._attached = None
+		self._serial_port = None
+
 	def default_config(self):
 		return dict(
 			ARDUINO_DIR = "/usr/share/arduino",
+			LIBRARY_PATHS = [],
 		)
 
 	def verify_config(self):
@@ -46,12 +144,179 @@ class Arduino(object):
 
 		self.verify_config()
 
-	def add_generator(self, srcs):
+	def add_generator(self, srcs, profile=None):
 		"""
 		Add a thing that produces a list of sources.
+
+		If it has a runtime() (name, sources, include paths), that's added with
+		add_runtime(). If it has a report(board, sketch), sketch() calls it for
+		more reports (nodes) to build with the size report.
 		"""
+		if hasattr(srcs, 'runtime'):
+			self.add_runtime(*srcs.runtime())
+		if hasattr(srcs, 'report'):
+			self._reports.append(srcs.report)
 		for src in srcs:
-			self.add(src)
+			self.add(src, profile=profile)
+
+	def profile(self, name, report=False):
+		"""
+		Set the optimization profile for the board: one of size (the default),
+		balanced, speed, debug.
+
+		With report on, whenever anything isn't built for size, sketch() also
+		links a size-optimized reference and prints the size difference after
+		every build. It's opt-in rather than on for every profile, since it
+		compiles everything twice.
+		"""
+		self._profile_flags(name)
+		self._profile = name
+		self.profile_report = report
+		self.env.Replace(OPTFLAGS=PROFILES[name])
+
+	def budget(self, flash=None, ram=None, eeprom=None, free_ram=None):
+		"""
+		Fail the build if the firmware uses more than this many bytes of flash,
+		RAM (.data + .bss) or EEPROM, or leaves less than free_ram bytes of RAM
+		for the stack and heap. Anything not given defaults to what the MCU has
+		(less the bootloader, for flash).
+		"""
+		for k, v in (('flash', flash), ('ram', ram), ('eeprom', eeprom), ('free_ram', free_ram)):
+			if v is not None:
+				self._budget[k] = v
+
+	def bootloader_size(self):
+		"""
+		Bytes of flash taken by the bootloader.
+		"""
+		return 0
+
+	def size_limits(self):
+		limits = dict(size.MCU_LIMITS.get(self.env.subst('$MCU'), {}))
+		if 'flash' in limits:
+			limits['flash'] -= self.bootloader_size()
+		limits.update(self._budget)
+		return limits
+
+	def _size_report(self, sketch, elf):
+		if 'SIZE' not in self.env:
+			print "WARNING: No size tool, not checking memory use"
+			return []
+		return self.env.Command(
+			self.build_dir.File(sketch+'.size.json'), elf,
+			self.env.Action(size.report, strfunction=size.describe, varlist=['SIZE_LIMITS']),
+			SIZE_LIMITS=self.size_limits(),
+		)
+
+	def size_history(self, on=True, top=history.TOP):
+		"""
+		Record per-symbol and per-object sizes on every build (on by default) and
+		print the top contributors to any growth since the last build and the
+		baseline. Build with SCONSDUINO_SIZE_BASELINE=1 to set the baseline.
+		"""
+		self._size_history = on
+		self._size_history_top = top
+
+	def _size_history_report(self, sketch, elf):
+		"""
+		The history lives in the user cache, so it survives cleaning.
+		"""
+		db = cache.cache_dir(self.config, 'history', cache.fingerprint(os.path.abspath(str(elf[0])))+'.json')
+		report = self.env.Command(
+			self.build_dir.File(sketch+'.symbols.json'), elf,
+			self.env.Action(history.track, strfunction=history.describe,
+				varlist=['SIZE_HISTORY_TOP', 'SIZE_HISTORY_BASELINE']),
+			SIZE_HISTORY=db,
+			# In the action's signature, so it takes effect on an up-to-date build
+			SIZE_HISTORY_BASELINE=bool(os.environ.get('SCONSDUINO_SIZE_BASELINE')),
+			SIZE_HISTORY_STRIP=str(self.variant_dir),
+			SIZE_HISTORY_TOP=self._size_history_top,
+		)
+		self.env.NoCache(report)
+		return report
+
+	def stack_usage(self, on=True):
+		"""
+		Compile with -fstack-usage and check the worst-case stack depth of main()
+		and the interrupt handlers, plus static RAM, against the MCU's RAM. The
+		core is always compiled in the project (not taken from the core cache),
+		since the cache doesn't keep .su files.
+		"""
+		self._stack_usage = on
+
+	def _stack_report(self, sketch, elf):
+		if 'OBJDUMP' not in self.env or 'SIZE' not in self.env:
+			print "WARNING: No objdump or size tool, not checking stack usage"
+			return []
+		objs = [o for o in self.objects + self._build_runtimes() + self._build_core() if str(o).endswith('.o')]
+		return self.env.Command(
+			self.build_dir.File(sketch+'.stack.json'), elf + objs,
+			self.env.Action(stack.report, strfunction=stack.describe, varlist=['SIZE_LIMITS']),
+			SIZE_LIMITS=self.size_limits(),
+		)
+
+	def isr_cycles(self, *functions, **kw):
+		"""
+		Count best and worst case cycles (and microseconds, at F_CPU) of the
+		interrupt handlers and the named functions, and report how they changed
+		since the last build. AVR only.
+
+		limit - Fail the build if anything can take longer than this many us
+		strict - Fail the build if any worst case got slower
+		"""
+		self._cycles = dict(functions=list(functions), limit=kw.get('limit'), strict=kw.get('strict', False))
+
+	def f_cpu(self):
+		"""
+		The F_CPU set by cpu() (or _FuseManager.clock()), or None. If it was set
+		more than once, the last one wins, as it does for gcc.
+		"""
+		hz = None
+		for flag in self.env.subst('$_CPPDEFFLAGS').split():
+			if flag.startswith('-DF_CPU='):
+				hz = int(float(flag[len('-DF_CPU='):].rstrip('UL')))
+		return hz
+
+	def _cycle_report(self, sketch, elf):
+		if not self.env.subst('$MCU').startswith('atmega'):
+			print "WARNING: Cycle counts are only for AVR, skipping"
+			return []
+		if 'OBJDUMP' not in self.env:
+			print "WARNING: No objdump, not counting cycles"
+			return []
+		report = self.env.Command(
+			self.build_dir.File(sketch+'.cycles.json'), elf,
+			self.env.Action(cycles.report, strfunction=cycles.describe,
+				varlist=['CYCLE_FUNCTIONS', 'CYCLE_LIMIT', 'CYCLE_STRICT', 'CYCLE_F_CPU']),
+			CYCLE_FUNCTIONS=self._cycles['functions'],
+			CYCLE_LIMIT=self._cycles['limit'],
+			CYCLE_STRICT=self._cycles['strict'],
+			CYCLE_F_CPU=self.f_cpu(),
+		)
+		# The last build's counts are compared against
+		self.env.Precious(report)
+		return report
+
+	def _profile_flags(self, name):
+		if name not in PROFILES:
+			raise ValueError("Unknown profile {!r}, expected one of {}".format(name, ', '.join(sorted(PROFILES))))
+		# The toolchain isn't known until sketch()
+		if '-Og' in PROFILES[name] and self._prepared and not self._has_og():
+			return DEBUG_FALLBACK
+		return PROFILES[name]
+
+	def _has_og(self):
+		"""
+		Whether $CC takes -Og (GCC 4.8 and newer). Checked once, with a warning
+		if it doesn't.
+		"""
+		if self._og is None:
+			ver = self.gcc_version()
+			self._og = ver is None or ver >= OG_MIN_GCC
+			if not self._og:
+				print "WARNING: {} is too old for -Og (need {}), debugging at {}".format(
+					self.env.subst('$CC'), '.'.join(map(str, OG_MIN_GCC)), ' '.join(DEBUG_FALLBACK))
+		return self._og
 
 	def cpu(self, speed):
 		"""
@@ -63,16 +328,325 @@ class Arduino(object):
 
 	def usb(self, vid, pid):
 		"""
-		Configure USB settings
+		Configure USB settings. Uploads look for a board with these IDs too.
 		"""
 		self.env.Append(
 			CPPDEFINES = {'USB_VID': vid, 'USB_PID': pid}
 		)
+		self._usb_ids.append((vid, pid))
+
+	def attached(self):
+		"""
+		The USB devices attached (see sconsduino.devices), cached in the user
+		cache until something is plugged in or out.
+		"""
+		if self._attached is None:
+			self._attached = devices.scan(cache.cache_dir(self.config, 'usb.json'))
+		return self._attached
+
+	def _usb_serial(self):
+		return os.environ.get('SCONSDUINO_USB_SERIAL') or self.config.get('USB_SERIAL')
+
+	def find_boards(self, ports=True):
+		"""
+		The attached devices that could be this board: by USB serial number if
+		SCONSDUINO_USB_SERIAL or USB_SERIAL (in ~/.arduino-scons) is set,
+		otherwise by the board's USB IDs and any given to usb().
+		"""
+		serial = self._usb_serial()
+		ids = None if serial else self.USB_IDS + self._usb_ids
+		return devices.find(self.attached(), ids, serial, ports=ports)
+
+	def serial_port(self):
+		"""
+		The port to upload to: SERIAL_PORT from ~/.arduino-scons, or else the
+		port of the first board found, or else DEFAULT_SERIAL_PORT.
+		"""
+		if self.config.get('SERIAL_PORT'):
+			return self.config['SERIAL_PORT']
+		if self._serial_port is None:
+			found = self.find_boards()
+			self._serial_port = found[0].port if found else self.DEFAULT_SERIAL_PORT
+		return self._serial_port
+
+	def _upload_port(self, target, source, env, for_signature):
+		"""
+		$SERIAL_PORT, for upload commands: serial_port(), looked up when it's
+		substituted.
+		"""
+		return self.serial_port() or ''
+
+	def _verify_serial_port(self):
+		"""
+		verify_upload() for boards uploaded to over a serial port.
+		"""
+		port = self.serial_port()
+		if port is None:
+			return "No board found; set SERIAL_PORT or USB_SERIAL in ~/.arduino-scons"
+		try:
+			if not stat.S_ISCHR(os.stat(port).st_mode):
+				return "SERIAL_PORT {} not a character device".format(port)
+		except OSError:
+			return "SERIAL_PORT {} not a character device".format(port)
+		if not self.config.get('SERIAL_PORT'):
+			found = self.find_boards()
+			if len(found) > 1:
+				print "WARNING: Uploading to {}; set USB_SERIAL to choose between:".format(port)
+				for d in found:
+					print "  {}".format(d)
+
+	def lto(self, on=True):
+		"""
+		Enable link-time optimization. Applied by sketch(), since it depends on the
+		toolchain.
+		"""
+		self._lto = on
+
+	def gcc_version(self):
+		"""
+		The version of $CC as a tuple of ints, or None if it can't be run.
+		"""
+		try:
+			out = subprocess.Popen([self.env.subst('$CC'), '-dumpversion'], stdout=subprocess.PIPE).communicate()[0]
+			return tuple(int(v) for v in out.strip().split('.') if v.isdigit())
+		except (OSError, ValueError):
+			return None
+
+	def _prepare(self):
+		"""
+		Apply settings that have to wait until the board is fully configured.
+		Called by sketch(); only does anything once.
+		"""
+		if self._prepared:
+			return
+		self._prepared = True
+		if self._tools is not None:
+			d, kw = self._tools
+			self.env.Replace(**self._find_tools(d, **kw))
+		if self._lto:
+			self._setup_lto()
+		self.env.Replace(OPTFLAGS=self._profile_flags(self._profile))
+		if self._stack_usage:
+			if self._lto:
+				print "WARNING: Stack usage can't be checked with LTO, skipping"
+				self._stack_usage = False
+			elif (self.gcc_version() or (0,)) < STACK_USAGE_MIN_GCC:
+				print "WARNING: {} is too old for -fstack-usage (need {}), not checking stack usage".format(
+					self.env.subst('$CC'), '.'.join(map(str, STACK_USAGE_MIN_GCC)))
+				self._stack_usage = False
+			else:
+				self.env.Append(CCFLAGS=['-fstack-usage'])
+		if self.object_cache:
+			self._setup_object_cache()
+		if self._distcc_hosts or self.config.get('DISTCC_HOSTS'):
+			self._setup_distcc()
+		if self._depfiles:
+			self._setup_depfiles()
+		if self._auto_libs:
+			self._resolve_libs()
+		self.variant_dir = self.build_dir.Dir(self._variant())
+		if self._pch:
+			self._setup_pch()
+		if self._unity:
+			self._roots.append(('unity', self.variant_dir.Dir('unity')))
+		for p, profile in self._libs:
+			name = 'libs/'+os.path.basename(os.path.normpath(os.path.join(*p)))
+			for src in self._unity_sources(self._find_sources(*p), name):
+				self._compile(src, profile)
+		for src, profile in self._added:
+			self._compile(src, profile)
+
+	def _variant(self):
+		"""
+		Name of the directory in build_dir for this board configuration, so
+		objects for different configurations live side by side.
+		"""
+		return "{}-{}".format(
+			self.env.subst('$MCU') or 'board',
+			cache.fingerprint(
+				cache.tool_version(self.env.subst('$CC')),
+				self.env.subst('$CC $CXX $CCFLAGS $CFLAGS $CXXFLAGS $_CPPDEFFLAGS'),
+			)[:8],
+		)
+
+	def _setup_object_cache(self):
+		"""
+		Share built files between checkouts and machines with SCons' CacheDir.
+
+		The cache directory is OBJECT_CACHE_DIR (from ~/.arduino-scons, or
+		SCONSDUINO_OBJECT_CACHE in the environment, eg a directory shared by CI
+		workers), split up by a fingerprint of the toolchain binaries and the
+		Arduino version. SCons' own signatures cover the flags and sources.
+		"""
+		root = (os.environ.get('SCONSDUINO_OBJECT_CACHE')
+			or self.config.get('OBJECT_CACHE_DIR')
+			or cache.cache_dir(self.config, 'objects'))
+		key = cache.fingerprint(
+			cache.arduino_version(self.env.subst('$ARDUINO')),
+			cache.tool_version(self.env.subst('$CC')),
+			*[cache.file_digest(self.env.subst(t)) for t in ('$CC', '$CXX', '$AR')]
+		)
+		limit = self.config.get('OBJECT_CACHE_SIZE', cache.DEFAULT_OBJECT_CACHE_SIZE)
+		cache.object_cache(self.env, os.path.expanduser(root), key, limit)
+
+	def distribute(self, *hosts):
+		"""
+		Send compiles to distcc-style workers, given as HOST[:PORT]. Also set with
+		DISTCC_HOSTS (a list) in ~/.arduino-scons. See sconsduino.distcc for
+		running workers. Compiles fall back to local if no worker can take them.
+		"""
+		self._distcc_hosts += hosts
+
+	def _setup_distcc(self):
+		hosts = self._distcc_hosts or self.config['DISTCC_HOSTS']
+		self.env.Replace(
+			DISTCC=[sys.executable, os.path.splitext(distcc.__file__)[0]+'.py', 'compile', ','.join(hosts), '--'],
+			CCCOM='$DISTCC '+self.env['CCCOM'],
+			CXXCOM='$DISTCC '+self.env['CXXCOM'],
+		)
+
+	def _setup_lto(self):
+		ver = self.gcc_version()
+		if ver is None or ver < LTO_MIN_GCC:
+			print "WARNING: {} is too old for LTO (need {}), building without it".format(
+				self.env.subst('$CC'), '.'.join(map(str, LTO_MIN_GCC)))
+			return
+		if 'GCC_AR' not in self.env or 'GCC_RANLIB' not in self.env:
+			print "WARNING: No gcc-ar/gcc-ranlib with {}, building without LTO".format(self.env.subst('$CC'))
+			return
+		self.env.Append(
+			CCFLAGS=['-flto'],
+			LINKFLAGS=['-flto', '-fuse-linker-plugin'],
+		)
+		# Archives need the LTO plugin to index the intermediate code.
+		self.env.Replace(
+			AR='$GCC_AR',
+			RANLIB='$GCC_RANLIB',
+		)
 
-	def libs(self, *libs):
+	def unity(self, chunk=8, exclude=()):
+		"""
+		Compile the core and each library as a few amalgamated files of up to
+		chunk sources each. Keep chunk small enough to leave work for -j.
+
+		exclude - Basenames of sources to always compile on their own, on top of
+		UNITY_UNSAFE. Files whose statics or #defines clash with others in the
+		same chunk, or that #define something before their first #include, are
+		also compiled on their own.
+		"""
+		self._unity = chunk
+		self._unity_exclude.update(exclude)
+
+	def _unity_sources(self, srcs, name):
+		"""
+		The sources to compile for a group of srcs (the core, or a library): the
+		srcs themselves, or unity files and the sources that can't go in one.
+		"""
+		srcs = list(srcs)
+		if not self._unity:
+			return srcs
+		chunks, singles = unity.group([self.env.File(s).get_abspath() for s in srcs], self._unity, self._unity_exclude)
+		out = []
+		for i, files in enumerate(chunks):
+			ext = os.path.splitext(files[0])[1]
+			out += self.env.Command(
+				self.variant_dir.Dir('unity').Dir(name).File('unity-{}{}'.format(i, ext)),
+				self.env.Value('\n'.join(files)),
+				self.env.Action(unity.write, strfunction=unity.describe),
+			)
+		return out + [self.env.File(s) for s in singles]
+
+	def pch(self, on=True):
+		"""
+		Precompile the core's main header (PCH_HEADERS) and use it for every C++
+		object built with the board's profile. gcc falls back to the real header
+		if the .gch doesn't fit.
+		"""
+		self._pch = on
+
+	def _setup_pch(self):
+		pchdir = self.variant_dir.Dir('pch')
+		core = self.env.Dir(self._core)
+		for h in self.PCH_HEADERS:
+			if not os.path.exists(core.File(h).get_abspath()):
+				continue
+			self._pch_nodes += self.env.Command(
+				pchdir.File(h+'.gch'), core.File(h),
+				'$CXX -x c++-header -o $TARGET -c $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCE',
+				PCHFLAGS=[],
+			)
+		if self._pch_nodes:
+			# gcc looks for foo.h.gch in each include directory before foo.h, so
+			# this has to be searched before CPPPATH.
+			self.env.Replace(PCHFLAGS=['-I'+str(pchdir), '-Winvalid-pch'])
+			# The core's own quoted includes find the header next to them first,
+			# so it gets the .gch with -include (through a stub next to it).
+			h = os.path.basename(str(self._pch_nodes[0]))[:-len('.gch')]
+			stub = self.env.Command(
+				pchdir.File(h), core.File(h),
+				self.env.Action(_pch_stub, None),
+			)
+			self._pch_nodes += stub
+			self._core_pchflags = ['-include', str(stub[0]), '-Winvalid-pch']
+
+	def depfiles(self, on=True):
+		"""
+		Have gcc write dependency files (-MMD) and use those instead of SCons'
+		C scanner. Objects without a .d yet (eg, the first build) are scanned as
+		usual.
+		"""
+		self._depfiles = on
+
+	def _setup_depfiles(self):
+		self.env.Append(
+			CCFLAGS=['-MMD', '-MF', '${TARGET}.d'],
+			BUILDERS={
+				'DepObject': self.env.Builder(
+					# Plain strings: env.Action() would substitute $TARGET away
+					action={'.c': '$CCCOM', '.cpp': '$CXXCOM'},
+					suffix='$OBJSUFFIX',
+					single_source=1,
+					# The .d supplies the dependencies
+					source_scanner=self.env.Scanner(function=lambda node, env, path: [], name='depfile'),
+				),
+			},
+		)
+
+	def _object(self, env, target, src, **kw):
+		"""
+		env.Object(target, src), depending on the precompiled headers if it's C++,
+		and with dependencies from gcc's .d file if depfiles is on.
+		"""
+		objs = self._object_deps(env, target, src, **kw)
+		if self._pch_nodes and str(src).endswith('.cpp'):
+			env.Depends(objs, self._pch_nodes)
+		if self._stack_usage:
+			# The object cache wouldn't bring the .su back
+			env.NoCache(objs)
+			for o in objs:
+				env.Clean(o, os.path.splitext(o.get_abspath())[0]+'.su')
+		return objs
+
+	def _object_deps(self, env, target, src, **kw):
+		if not self._depfiles:
+			return env.Object(target, src, **kw)
+		d = target.get_abspath()+'.d'
+		deps = depfile.deps(d)
+		if deps is None:
+			objs = env.Object(target, src, **kw)
+		else:
+			objs = env.DepObject(target, src, **kw)
+			env.Depends(objs, deps)
+		env.Clean(objs, d)
+		return objs
+
+	def libs(self, *libs, **kw):
 		"""
 		Add Arduino libraries
+
+		profile - Optimization profile for these libraries, instead of the board's
 		"""
+		profile = kw.get('profile')
 		for l in libs:
 			if not l:
 				self.env.Exit("Cowardly refusing to add an empty library.")
@@ -86,19 +660,68 @@ class Arduino(object):
 			if not os.path.exists(d):
 				self.env.Exit("Can't find library {!r} ({})".format(l, d))
 
-			self.add_generator(self._find_sources(*p))
+			self._libs.append((p, profile))
+			self._roots.append(('libs/'+os.path.basename(os.path.normpath(d)), self.env.Dir(d)))
 			self.env.Append(CPPPATH=[d])
 			if os.path.exists(os.path.join(d, 'utility')):
 				self.env.Append(CPPPATH=[os.path.join(d, 'utility')])
+			if os.path.exists(os.path.join(d, 'src')):
+				self.env.Append(CPPPATH=[os.path.join(d, 'src')])
+
+	def auto_libs(self, on=True):
+		"""
+		Find libraries by following the sketch's #includes, in addition to the ones
+		given to libs(). Searches LIBRARY_PATHS (from ~/.arduino-scons), then
+		$ARDUINO/libraries.
+		"""
+		self._auto_libs = on
+
+	def _scan(self):
+		return scan.get(cache.cache_dir(self.config, 'scan.json'))
+
+	def _resolve_libs(self):
+		index = libindex.LibraryIndex(
+			cache.cache_dir(self.config, 'libindex.json'),
+			self._scan(),
+			list(self.config.get('LIBRARY_PATHS', [])) + [os.path.join(self.env.subst('$ARDUINO'), 'libraries')],
+		)
+		files = [str(f) for f in self._sketch_sources(exts=libindex.SOURCE_EXTS)]
+		files += [self.env.File(src).get_abspath() for src, _ in self._added]
+		known = [os.path.join(*p) for p, _ in self._libs]
+		for lib in index.resolve(files, known, [self.src_dir.srcnode().get_abspath()]):
+			print "Using library {}".format(lib)
+			self.libs(lib)
+
+	def _sketch_sources(self, **kw):
+		"""
+		Sources in src_dir, leaving out build_dir (where generated sources go) if
+		it's inside src_dir. If they're the same directory, the board variant
+		directories are left out.
+		"""
+		src = self.src_dir.srcnode().get_abspath()
+		build = self.build_dir.get_abspath()
+		if build == src:
+			return self._find_sources(src, prune_names=VARIANT, **kw)
+		return self._find_sources(src, prune=[build], **kw)
 
 	def _find_sources(self, *dirs, **kw):
+		"""
+		prune - Directories (absolute) to leave out
+		prune_names - Regex for names of directories right under the top one to
+		leave out
+		"""
 		exts = kw.get('exts', ['.c', '.cpp'])
+		prune = kw.get('prune', ())
+		prune_names = kw.get('prune_names')
 		d = os.path.join(*dirs)
 		d = str(d)
-		print "Searching {} for sources...".format(d)
-		for d, dns, fns in os.walk(d):
+		top = os.path.abspath(d)
+		for d, dns, fns in self._scan().walk(d):
 			if 'examples' in dns:
 				dns.remove('examples')
+			for dn in list(dns):
+				if os.path.join(d, dn) in prune or (prune_names and d == top and prune_names.match(dn)):
+					dns.remove(dn)
 			for fn in fns:
 				_, ext = os.path.splitext(fn)
 				ffn = os.path.join(d, fn)
@@ -106,6 +729,13 @@ class Arduino(object):
 					#print ffn
 					yield self.env.File(ffn)
 
+	def _use_tools(self, d, **kw):
+		"""
+		Set the toolchain directory; see _find_tools(). The tools are looked up by
+		sketch().
+		"""
+		self._tools = d, kw
+
 	def _find_tools(self, d, **kw):
 		d = str(d)
 		f = "{}"
@@ -115,26 +745,342 @@ class Arduino(object):
 			f = f+kw['suffix']
 		return {
 			v: os.path.join(d, f.format(t))
-			for v,t in (('CC', 'gcc'), ('CXX', 'g++'), ('OBJCOPY', 'objcopy'), ('SIZE', 'size'))
+			for v,t in (
+				('CC', 'gcc'), ('CXX', 'g++'), ('AR', 'ar'), ('RANLIB', 'ranlib'),
+				('GCC_AR', 'gcc-ar'), ('GCC_RANLIB', 'gcc-ranlib'), ('OBJCOPY', 'objcopy'), ('OBJDUMP', 'objdump'), ('SIZE', 'size'),
+			)
 			if os.path.exists(os.path.join(d, f.format(t)))
 		}
 
 	def _find_core(self, core):
-		self.add_generator(self._find_sources(core))
+		"""
+		Register the core. Must be called after the core's include paths are in
+		CPPPATH, and before any libraries are.
+
+		The core is actually compiled by sketch(), once all the settings are in.
+		"""
+		self._core = core
+		self._roots.append(('core', self.env.Dir(core)))
+		self._core_cpppath = [p for p in self.env['CPPPATH'] if p is not self.src_dir]
 
-	def add(self, src):
-		base = os.path.basename(str(src))
-		_, ext = os.path.splitext(base)
+	def _core_key(self, env):
+		"""
+		Everything that can change the compiled core.
+		"""
+		# The precompiled header lives in the project, and doesn't change the output
+		env = env.Override({'PCHFLAGS': []})
+		files = []
+		for p in self._core_cpppath:
+			files += self._find_sources(env.Dir(p).get_abspath(), exts=['.c', '.cpp', '.h'])
+		return cache.fingerprint(
+			str(self._core),
+			cache.tool_version(env.subst('$CC')),
+			cache.tool_version(env.subst('$CXX')),
+			env.subst('$MCU'),
+			env.subst('$CC $CXX $CCFLAGS $CFLAGS $CXXFLAGS $_CPPDEFFLAGS $_CPPINCFLAGS'),
+			# Contents, not mtimes: reinstalls touch every file, and copies can
+			# keep the mtime of a file that changed
+			*sorted("{}:{}".format(f, cache.file_digest(str(f))) for f in files)
+		)
+
+	def _core_srcs(self):
+		if self._core_sources is None:
+			self._core_sources = []
+			if self._core is not None:
+				self._core_sources = self._unity_sources(self._find_sources(self._core), 'core')
+		return self._core_sources
+
+	def _build_core(self):
+		"""
+		Compile the core and return what to link against. This goes last on the
+		link line, since it's an archive.
+
+		If core_cache is on, the core is archived into libcore.a and published to
+		the user cache, keyed on the board configuration and compiler, and reused
+		by every sketch with the same configuration.
+		"""
+		if self._core_objects is not None:
+			return self._core_objects
+		self._core_objects = []
+		if self._core is None:
+			return self._core_objects
+		env = self.env.Override({'CPPPATH': self._core_cpppath, 'PCHFLAGS': self._core_pchflags})
+		if not self.core_cache or self._stack_usage:
+			self._core_objects = self._archive(env, 'core', self._core_srcs())
+		else:
+			self._core_objects = self._archive(env, 'core', self._core_srcs(), self._core_key(env))
+		return self._core_objects
+
+	def _archive(self, env, name, srcs, key=None):
+		"""
+		Compile srcs. With a key, they're archived into lib<name>.a and published
+		to the user cache under <name>/<key>, or taken from there if it's
+		already built.
+		"""
+		objs = []
+		cached = key and self.env.File(cache.cache_dir(self.config, name, key, 'lib'+name+'.a'))
+		if cached and os.path.exists(cached.get_abspath()):
+			print "Using cached {} {}".format(name, cached)
+			return [cached]
+		for src in srcs:
+			objs += self._object(env, self._object_path(src), src)
+		if not cached:
+			return objs
+		lib = env.StaticLibrary(self.variant_dir.Dir(name).File('lib'+name+'.a'), objs)
+		self.env.NoCache(self.env.Command(cached, lib, cache.publish))
+		return [cached]
+
+	def add_runtime(self, name, srcs, cpppath=()):
+		"""
+		Link against a runtime library (like nanopb's) that doesn't depend on
+		the sketch. Like the core, it's compiled once per board configuration
+		into lib<name>.a in the user cache, unless core_cache is off.
+
+		cpppath - The include paths it needs, instead of the sketch's
+		"""
+		srcs = [self.env.File(src) for src in srcs]
+		for d in set(src.get_dir() for src in srcs):
+			self._roots.append((name, d))
+		self._runtimes.append((name, srcs, list(cpppath)))
+
+	def _runtime_key(self, env, name, srcs, cpppath):
+		"""
+		Everything that can change a compiled runtime.
+		"""
+		env = env.Override({'PCHFLAGS': []})
+		files = [src.get_abspath() for src in srcs]
+		for p in cpppath:
+			files += glob.glob(os.path.join(env.Dir(p).get_abspath(), '*.h'))
+		return cache.fingerprint(
+			name,
+			cache.tool_version(env.subst('$CC')),
+			cache.tool_version(env.subst('$CXX')),
+			env.subst('$MCU'),
+			env.subst('$CC $CXX $CCFLAGS $CFLAGS $CXXFLAGS $_CPPDEFFLAGS $_CPPINCFLAGS'),
+			*sorted("{}:{}".format(os.path.basename(f), cache.file_digest(f)) for f in files)
+		)
+
+	def _build_runtimes(self):
+		"""
+		Compile the runtimes given to add_runtime(), and return what to link
+		against.
+		"""
+		if self._runtime_objects is None:
+			self._runtime_objects = []
+			for name, srcs, cpppath in self._runtimes:
+				env = self.env.Override({'CPPPATH': cpppath})
+				key = None
+				if self.core_cache and not self._stack_usage:
+					key = self._runtime_key(env, name, srcs, cpppath)
+				self._runtime_objects += self._archive(env, name, srcs, key)
+		return self._runtime_objects
+
+	def _object_path(self, src, base=None):
+		"""
+		Where to put the object for src: its path mirrored under core/,
+		libs/<name>/, sketch/ or gen/ (generated sources in build_dir), so files
+		with the same name never collide. Anything else goes under ext/.
+
+		Paths are relative to base, by default the variant directory.
+		"""
+		base = base or self.variant_dir
+		path = self.env.File(src).get_abspath()
+		best = None
+		for sub, root in self._roots:
+			r = root.get_abspath()
+			if path.startswith(r+os.sep) and (best is None or len(r) > len(best[1])):
+				best = sub, r
+		if best is None:
+			rel = os.path.join('ext', path.lstrip(os.sep))
+		else:
+			rel = os.path.join(best[0], os.path.relpath(path, best[1]))
+		return base.File(rel+'.o')
+
+	def add(self, src, profile=None):
+		"""
+		Compile a source file into the sketch. The object is created by sketch(),
+		once the board configuration is final.
+
+		profile - Optimization profile for this file, instead of the board's
+		"""
+		_, ext = os.path.splitext(str(src))
 		if ext not in ('.c', '.cpp'):
 			raise ValueError("Unknown extension: {}".format(ext))
-		self.objects += self.env.Object(self.build_dir.File(base+'.o'), src)
+		if profile is not None:
+			self._profile_flags(profile)
+		if self._prepared:
+			self._compile(src, profile)
+		else:
+			self._added.append((src, profile))
+
+	def _compile(self, src, profile):
+		kw = {}
+		if profile is not None:
+			kw['OPTFLAGS'] = self._profile_flags(profile)
+			if kw['OPTFLAGS'] != self._profile_flags(self._profile):
+				# The .gch is only valid with the flags it was built with
+				kw['PCHFLAGS'] = []
+		objs = self._object(self.env, self._object_path(src), src, **kw)
+		self.sources += [(src, profile, o) for o in objs]
+		self.objects += objs
+
+	def _reference(self, sketch):
+		"""
+		Link the sketch again with everything built for the default profile.
+		Returns the reference ELF and a label for the profiles in use, or None if
+		the sketch already is the reference.
+		"""
+		profiles = set(p or self._profile for _, p, _ in self.sources)
+		profiles.add(self._profile)
+		if profiles == set([DEFAULT_PROFILE]):
+			return None
+		ref = self.env.Override({'OPTFLAGS': PROFILES[DEFAULT_PROFILE], 'PCHFLAGS': []})
+		refdir = self.variant_dir.Dir('ref-'+DEFAULT_PROFILE)
+		objs = []
+		for src, p, o in self.sources:
+			if (p or self._profile) == DEFAULT_PROFILE:
+				objs.append(o)
+			else:
+				objs += self._object(ref, self._object_path(src, refdir), src)
+		objs += self._build_runtimes()
+		if self._profile == DEFAULT_PROFILE:
+			objs += self._build_core()
+		else:
+			core = ref.Override({'CPPPATH': self._core_cpppath})
+			for src in self._core_srcs():
+				objs += self._object(core, self._object_path(src, refdir), src)
+		return ref.Program(refdir.File(sketch+'.elf'), objs), '+'.join(sorted(profiles))
+
+	def verify_upload(self, target, source, env):
+		"""
+		SCons action run right before uploading. Return an error message to stop.
+		"""
+		return None
+
+	def _stk500_upload(self, bauds, erase=False, fuses=None, reset=True):
+		"""
+		An action uploading over STK500v1 to $SERIAL_PORT, without avrdude. Set
+		UPLOADER = 'avrdude' in ~/.arduino-scons to use avrdude instead, and
+		UPLOAD_BAUDS to override the baud rates tried.
+
+		Only pages that changed since the last upload to the port are written,
+		and only fuses that differ; what was last uploaded is kept in the user
+		cache.
+
+		erase - Chip erase first (ISP programmers)
+		fuses - (low, high, extended) to write
+		reset - Reset the board into its bootloader (not for ISP programmers)
+		"""
+		self._stk500 = dict(bauds=self.config.get('UPLOAD_BAUDS') or bauds, erase=erase, fuses=fuses, reset=reset)
+		up = stk500.Upload('$SERIAL_PORT', state=self._flash_state, **self._stk500)
+		return self.env.Action(up, strfunction=up.describe)
+
+	def _flash_state(self, port):
+		return cache.cache_dir(self.config, 'flashed', cache.fingerprint(os.path.realpath(port))+'.json')
+
+	def farm(self, *devices, **kw):
+		"""
+		Set up the flashing farm (the farm and farm-<sketch> targets), which
+		flashes every device at once. Devices are ports or USB serial numbers;
+		with none given here, SCONSDUINO_FARM (comma-separated) or FARM_DEVICES
+		in ~/.arduino-scons is used, and failing that every attached board with
+		the board's USB IDs.
+
+		workers - How many to flash at once (default: all of them)
+		retries - How many times to retry each device
+		"""
+		self._farm = dict(kw, devices=list(devices))
+
+	def _farm_devices(self):
+		if self._farm.get('devices'):
+			names = self._farm['devices']
+		elif os.environ.get('SCONSDUINO_FARM'):
+			names = [d for d in os.environ['SCONSDUINO_FARM'].split(',') if d]
+		else:
+			names = self.config.get('FARM_DEVICES')
+		if not names:
+			return [d.port for d in devices.find(self.attached(), self.USB_IDS + self._usb_ids, ports=True)]
+		# Serial numbers to ports
+		ports = {d.serial: d.port for d in devices.find(self.attached(), ports=True) if d.serial}
+		return [ports.get(n, n) for n in names]
+
+	def _farm_flash(self, port, hexfile):
+		stk500.upload(
+			port, self.env.subst('$MCU'), hexfile,
+			state=self._flash_state(port), **self._stk500
+		)
+
+	def _flash_farm(self, sketch, hex):
+		"""
+		Only boards with the built-in uploader can be flashed in parallel.
+		"""
+		if self._stk500 is None:
+			return []
+		f = farm.Farm(
+			self._farm_devices, self._farm_flash,
+			workers=self._farm.get('workers'), retries=self._farm.get('retries', farm.DEFAULT_RETRIES),
+			errors=(stk500.UploadError, EnvironmentError),
+		)
+		report = self.env.Command(self.build_dir.File(sketch+'.farm.json'), hex, self.env.Action(f, strfunction=f.describe))
+		self.env.AlwaysBuild(report)
+		return report
+
+	def _check_upload(self, target, source, env):
+		err = self.verify_upload(target, source, env)
+		if err:
+			print "ERROR: {}".format(err)
+			return 1
+
+	def _upload(self, hex):
+		return self.env.Command(None, hex, [self.env.Action(self._check_upload, None), self.upload_command()])
 
 	def sketch(self, sketch, upload=True):
-		self.add_generator(self._find_sources(self.src_dir))
-		elf = self.env.Program(sketch+'.elf', self.objects)
-		eep = self.env.Command(sketch+'.eep', elf, '$OBJCOPY -O ihex -j .eeprom --set-section-flags=.eeprom=alloc,load --no-change-warnings --change-section-lma .eeprom=0 $SOURCE $TARGET')
-		hex = self.env.Command(sketch+'.hex', elf, '$OBJCOPY -O ihex -R .eeprom $SOURCE $TARGET')
-		self.env.Default(hex, eep)
-		self.env.Alias('upload-'+sketch, self.env.Command(None, hex, self.upload_command()))
+		if self.env.GetOption('help'):
+			# Nothing to build, don't bother scanning.
+			return
+		self._prepare()
+		self.add_generator(self._sketch_sources())
+		kw = {}
+		if self._size_history:
+			# Only for this link; the environment is shared with other sketches
+			kw['LINKFLAGS'] = self.env['LINKFLAGS'] + ['-Wl,-Map,${TARGET.base}.map']
+		elf = self.env.Program(sketch+'.elf', self.objects + self._build_runtimes() + self._build_core(), **kw)
+		if self._size_history:
+			self.env.SideEffect(sketch+'.map', elf)
+			self.env.Clean(elf, sketch+'.map')
+			self.env.Default(self._size_history_report(sketch, elf))
+		if self.profile_report and 'SIZE' not in self.env:
+			print "WARNING: No size tool, not comparing against the {} profile".format(DEFAULT_PROFILE)
+		elif self.profile_report:
+			ref = self._reference(sketch)
+			if ref is not None:
+				ref, label = ref
+				self.env.Default(self.env.Command(
+					self.build_dir.File(sketch+'.profile'), [elf, ref], size.delta,
+					PROFILE_NAME=label, PROFILE_REF=DEFAULT_PROFILE,
+				))
+		# All the images in one pass, without objcopy
+		images = self.env.Command(
+			[sketch+ext for ext in self.IMAGES], elf,
+			self.env.Action(elffile.images, strfunction=elffile.describe),
+		)
+		hex = images[0]
+		self.env.Default(images)
+		report = self._size_report(sketch, elf)
+		if self._stack_usage:
+			report += self._stack_report(sketch, elf)
+		if self._cycles is not None:
+			report += self._cycle_report(sketch, elf)
+		for r in self._reports:
+			report += r(self, sketch)
+		if report:
+			# Don't make anything uploadable that's over budget
+			self.env.Depends(images, report)
+		self.env.Alias('upload-'+sketch, self._upload(hex))
+		flash_farm = self._flash_farm(sketch, hex)
+		if flash_farm:
+			self.env.Alias('farm-'+sketch, flash_farm)
+			if upload:
+				self.env.Alias('farm', flash_farm)
 		if upload:
-			self.env.Alias('upload', self.env.Command(None, hex, self.upload_command()))
+			self.env.Alias('upload', self._upload(hex))
@@ -1,12 +1,30 @@
-from .. import Arduino
-import stat
-import os
+from .. import Arduino, devices
 
 class Mega(Arduino):
 	PARTS = {
 		2560: 'atmega2560',
 		1280: 'atmega1280',
 	}
+	BOOTLOADER = {
+		2560: 8192,
+		1280: 4096,
+	}
+	# The 2560's own USB, or the 1280's FTDI (and clones)
+	USB_IDS = devices.MEGA2560 + devices.FTDI + devices.CH340
+	# Defines ARDUINO_MAIN before including pins_arduino.h, to get the pin tables
+	UNITY_UNSAFE = ['wiring_digital.c']
+	DEFAULT_SERIAL_PORT = '/dev/ttyACM0'
+	# Fastest first
+	UPLOAD_BAUDS = {
+		2560: [115200],
+		1280: [57600],
+	}
+	# avrdude programmer: the 2560's bootloader speaks STK500v2, which only
+	# avrdude does, so it's always flashed in full
+	PROGRAMMERS = {
+		2560: 'wiring',
+		1280: 'arduino',
+	}
 
 	def __init__(self, *p, **kw):
 		super(Mega, self).__init__(*p, **kw)
@@ -31,27 +49,19 @@ class Mega(Arduino):
 			LOAD='avrdude', # /home/james/.local/arduino/hardware/tools/avrdude -C$(ARDUINO)/hardware/tools/avrdude.conf -patmega328p -cstk500v1 -P$(SER) -b19200 -Uflash:w:$<.hex:i 
 			LOADFLAGS=[],
 		)
-		self.env.Replace(
-			**self._find_tools(self.env.Dir("$ARDUINO").Dir('hardware').Dir('tools').Dir('avr').Dir('bin'), prefix='avr-')
-		)
+		self._use_tools(self.env.Dir("$ARDUINO").Dir('hardware').Dir('tools').Dir('avr').Dir('bin'), prefix='avr-')
 		self._find_core(self.env['COREPATH'])
 
-	def default_config(self):
-		d = super(Mega, self).default_config()
-		d.update(
-			SERIAL_PORT = '/dev/ttyACM0',
-		)
-		return d
+	def bootloader_size(self):
+		return self.BOOTLOADER[self.chip]
 
-	def verify_config(self):
-		super(Mega, self).verify_config()
-		if not stat.S_ISCHR(os.stat(self.config['SERIAL_PORT']).st_mode):
-			self.env.Exit("SERIAL_PORT not a character device")
+	def verify_upload(self, target, source, env):
+		return self._verify_serial_port()
 
 	def upload_command(self):
-		if self.chip == 328:
-			baud = 57600
-		elif self.chip == 168:
-			baud = 19200
-		return "$ARDUINO/hardware/tools/avrdude -C$ARDUINO/hardware/tools/avrdude.conf -p$MCU -carduino -P{} -b{} -D -Uflash:w:$SOURCE:i".format(self.config['SERIAL_PORT'], baud)
+		bauds = self.UPLOAD_BAUDS[self.chip]
+		if self.config.get('UPLOADER') == 'avrdude' or self.PROGRAMMERS[self.chip] != 'arduino':
+			return "$ARDUINO/hardware/tools/avrdude -C$ARDUINO/hardware/tools/avrdude.conf -p$MCU -c{} -P$SERIAL_PORT -b{} -D -Uflash:w:$SOURCE:i".format(
+				self.PROGRAMMERS[self.chip], bauds[0])
+		return self._stk500_upload(bauds)
 
@@ -1,6 +1,4 @@
-from .. import Arduino
-import stat
-import os
+from .. import Arduino, devices
 
 class ProMini(Arduino):
 	PARTS = {
@@ -11,6 +9,20 @@ class ProMini(Arduino):
 		5.0: 16000000,
 		3.3:  8000000
 	}
+	BOOTLOADER = {
+		328: 2048,
+		168: 2048,
+	}
+	# Whatever USB serial adapter it's on
+	USB_IDS = devices.FTDI + devices.CH340 + devices.CP210X
+	# Defines ARDUINO_MAIN before including pins_arduino.h, to get the pin tables
+	UNITY_UNSAFE = ['wiring_digital.c']
+	DEFAULT_SERIAL_PORT = '/dev/ttyUSB0'
+	# Fastest first: optiboot, then the old ATmegaBOOT
+	UPLOAD_BAUDS = {
+		328: [115200, 57600],
+		168: [19200],
+	}
 
 	def __init__(self, *p, **kw):
 		super(ProMini, self).__init__(*p, **kw)
@@ -38,27 +50,21 @@ class ProMini(Arduino):
 			LOAD='avrdude', # /home/james/.local/arduino/hardware/tools/avrdude -C$(ARDUINO)/hardware/tools/avrdude.conf -patmega328p -cstk500v1 -P$(SER) -b19200 -Uflash:w:$<.hex:i 
 			LOADFLAGS=[],
 		)
-		self.env.Replace(
-			**self._find_tools(self.env.Dir("$ARDUINO").Dir('hardware').Dir('tools').Dir('avr').Dir('bin'), prefix='avr-')
-		)
+		self._use_tools(self.env.Dir("$ARDUINO").Dir('hardware').Dir('tools').Dir('avr').Dir('bin'), prefix='avr-')
 		self._find_core(self.env['COREPATH'])
 
-	def default_config(self):
-		d = super(ProMini, self).default_config()
-		d.update(
-			SERIAL_PORT = '/dev/ttyUSB0',
-		)
-		return d
+	def bootloader_size(self):
+		return self.BOOTLOADER[self.chip]
 
-	def verify_config(self):
-		super(ProMini, self).verify_config()
-		if not stat.S_ISCHR(os.stat(self.config['SERIAL_PORT']).st_mode):
-			self.env.Exit("SERIAL_PORT not a character device")
+	def verify_upload(self, target, source, env):
+		return self._verify_serial_port()
 
 	def upload_command(self):
-		if self.chip == 328:
-			baud = 57600
-		elif self.chip == 168:
-			baud = 19200
-		return "$ARDUINO/hardware/tools/avrdude -C$ARDUINO/hardware/tools/avrdude.conf -p$MCU -carduino -P{} -b{} -D -Uflash:w:$SOURCE:i".format(self.config['SERIAL_PORT'], baud)
+		if self.config.get('UPLOADER') == 'avrdude':
+			if self.chip == 328:
+				baud = 57600
+			elif self.chip == 168:
+				baud = 19200
+			return "$ARDUINO/hardware/tools/avrdude -C$ARDUINO/hardware/tools/avrdude.conf -p$MCU -carduino -P$SERIAL_PORT -b{} -D -Uflash:w:$SOURCE:i".format(baud)
+		return self._stk500_upload(self.UPLOAD_BAUDS[self.chip])
 
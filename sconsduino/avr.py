@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from . import Arduino
-import os
-import stat
+from . import Arduino, devices
 
 class _FuseManager(object):
 	"""
@@ -337,6 +335,11 @@ class Atmega328(Arduino):
 
 	Supported chips: ATmega328/P
 	"""
+	# ArduinoISP on an Uno (or a clone)
+	USB_IDS = devices.UNO + devices.CH340
+	# Defines ARDUINO_MAIN before including pins_arduino.h, to get the pin tables
+	UNITY_UNSAFE = ['wiring_digital.c']
+	DEFAULT_SERIAL_PORT = '/dev/ttyACM0'
 
 	def __init__(self, *p, **kw):
 		super(Atmega328, self).__init__(*p, **kw)
@@ -344,39 +347,45 @@ class Atmega328(Arduino):
 		self.env.Append(
 			COREPATH=self.env.Dir("$ARDUINO").Dir('hardware').Dir('arduino').Dir('cores').Dir('arduino'),
 			CPPPATH=['$COREPATH', self.env.Dir("$ARDUINO").Dir("hardware").Dir("arduino").Dir("variants").Dir("standard")],
+			MCU=self.partno,
 			# C/C++
-			CCFLAGS=['-mmcu='+self.partno],
+			CCFLAGS=['-mmcu=$MCU'],
 			# C only
 			CFLAGS=[],
 			# C++ only
 			CXXFLAGS=[],
-			LINKFLAGS=['-mmcu='+self.partno],
+			LINKFLAGS=['-mmcu=$MCU'],
 			LIBS=['m'],
 			LOAD='avrdude', # /home/james/.local/arduino/hardware/tools/avrdude -C$(ARDUINO)/hardware/tools/avrdude.conf -patmega328p -cstk500v1 -P$(SER) -b19200 -Uflash:w:$<.hex:i 
 			LOADFLAGS=[],
 		)
-		self.env.Replace(
-			**self._find_tools(self.env.Dir("$ARDUINO").Dir('hardware').Dir('tools').Dir('avr').Dir('bin'), prefix='avr-')
-		)
+		self._use_tools(self.env.Dir("$ARDUINO").Dir('hardware').Dir('tools').Dir('avr').Dir('bin'), prefix='avr-')
 		self._find_core(self.env['COREPATH'])
 
 	def fuses(self):
 		return _FuseManager(self)
 
-	def default_config(self):
-		d = super(Atmega328, self).default_config()
-		d.update(
-			SERIAL_PORT = '/dev/ttyACM0',
-		)
-		return d
+	def bootloader_size(self):
+		# Set by _FuseManager; BOOTRST programmed (0) means there's a bootloader
+		fuses = self.__dict__.get('fuses')
+		if fuses is None or fuses[1] & 1:
+			return 0
+		words = {0b11: 256, 0b10: 512, 0b01: 1024, 0b00: 2048}[(fuses[1] >> 1) & 0b11]
+		return words * 2
+
+	def verify_upload(self, target, source, env):
+		return self._verify_serial_port()
 
-	def verify_config(self):
-		super(Atmega328, self).verify_config()
-		if not stat.S_ISCHR(os.stat(self.config['SERIAL_PORT']).st_mode):
-			self.env.Exit("SERIAL_PORT not a character device")
+	# ArduinoISP's baud rate is fixed. Trying others would reset the Uno it
+	# runs on into optiboot, which answers at 115200 and flashes the Uno.
+	UPLOAD_BAUDS = [19200]
 
 	def upload_command(self):
-		f = ""
-		if hasattr(self, 'fuses'):
-			f = "-Ulfuse:w:0x{:02x}:m -Uhfuse:w:0x{:02x}:m -Uefuse:w:0x{:02x}:m".format(*self.fuses)
-		return "$ARDUINO/hardware/tools/avrdude -C$ARDUINO/hardware/tools/avrdude.conf -patmega328p -cstk500v1 -P{} -b19200 {} -Uflash:w:$SOURCE:i".format(self.config['SERIAL_PORT'], f)
+		# Set by _FuseManager (otherwise it's the method)
+		fuses = self.__dict__.get('fuses')
+		if self.config.get('UPLOADER') == 'avrdude':
+			f = ""
+			if fuses is not None:
+				f = "-Ulfuse:w:0x{:02x}:m -Uhfuse:w:0x{:02x}:m -Uefuse:w:0x{:02x}:m".format(*fuses)
+			return "$ARDUINO/hardware/tools/avrdude -C$ARDUINO/hardware/tools/avrdude.conf -patmega328p -cstk500v1 -P$SERIAL_PORT -b19200 {} -Uflash:w:$SOURCE:i".format(f)
+		return self._stk500_upload(self.UPLOAD_BAUDS, erase=True, fuses=fuses, reset=False)
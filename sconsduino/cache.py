@@ -0,0 +1,147 @@
+"""
+User-level caches shared between projects.
+
+Everything lives under CACHE_DIR (from ~/.arduino-scons), which defaults to
+~/.cache/sconsduino.
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import hashlib
+import subprocess
+import atexit
+
+DEFAULT_CACHE_DIR = "~/.cache/sconsduino"
+# Megabytes
+DEFAULT_OBJECT_CACHE_SIZE = 1024
+
+_versions = {}
+_digests = {}
+_object_caches = {}
+
+def cache_dir(config, *parts):
+	"""
+	Returns a path inside the user cache.
+	"""
+	base = os.path.expanduser(config.get('CACHE_DIR') or DEFAULT_CACHE_DIR)
+	return os.path.join(base, *parts)
+
+def tool_version(tool):
+	"""
+	The first line of `tool --version`, memoized per tool.
+	"""
+	if tool not in _versions:
+		try:
+			out = subprocess.Popen([tool, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+			_versions[tool] = out.splitlines()[0].strip() if out else ''
+		except OSError:
+			_versions[tool] = ''
+	return _versions[tool]
+
+def fingerprint(*bits):
+	"""
+	Hashes a bunch of strings into a short, path-safe key.
+	"""
+	h = hashlib.sha1()
+	for b in bits:
+		h.update(str(b))
+		h.update('\0')
+	return h.hexdigest()[:16]
+
+def publish(target, source, env):
+	"""
+	SCons action: copy a file into the cache, atomically.
+	"""
+	dest = str(target[0])
+	tmp = "{}.{}.tmp".format(dest, os.getpid())
+	shutil.copyfile(str(source[0]), tmp)
+	os.rename(tmp, dest)
+
+def file_digest(path):
+	"""
+	MD5 of a file's contents, memoized. Empty if it can't be read.
+	"""
+	if path not in _digests:
+		h = hashlib.md5()
+		try:
+			with open(path, 'rb') as f:
+				for block in iter(lambda: f.read(1 << 16), b''):
+					h.update(block)
+			_digests[path] = h.hexdigest()
+		except IOError:
+			_digests[path] = ''
+	return _digests[path]
+
+def arduino_version(arduino_dir):
+	"""
+	The Arduino IDE version, from lib/version.txt.
+	"""
+	try:
+		with open(os.path.join(arduino_dir, 'lib', 'version.txt')) as f:
+			return f.read().strip()
+	except IOError:
+		return ''
+
+def object_cache(env, root, key, limit):
+	"""
+	Point env's CacheDir at root/key. At exit, hit/miss statistics are printed
+	and root is trimmed to limit megabytes, least recently used first.
+	"""
+	path = os.path.join(root, key)
+	env.CacheDir(path)
+	if root not in _object_caches:
+		atexit.register(_finish_object_cache, env, root)
+	_object_caches[root] = limit
+
+def _finish_object_cache(env, root):
+	cd = env.get_CacheDir()
+	if cd.requests:
+		print "Object cache: {} hits, {} misses ({:.0f}% hit rate)".format(cd.hits, cd.misses, cd.hit_ratio)
+	evict(root, _object_caches[root] * 1024 * 1024)
+
+def _entries(root):
+	"""
+	The cached files in every CacheDir under root: root/<key>/<prefix>/<sig>.
+	Anything else, like each CacheDir's config (without which SCons stops
+	finding its entries), isn't one.
+	"""
+	for key in os.listdir(root):
+		kd = os.path.join(root, key)
+		if not os.path.isdir(kd):
+			continue
+		for prefix in os.listdir(kd):
+			pd = os.path.join(kd, prefix)
+			if not os.path.isdir(pd):
+				continue
+			for fn in os.listdir(pd):
+				yield os.path.join(pd, fn)
+
+def evict(root, limit):
+	"""
+	Delete the least recently used cache entries under root until they're
+	under limit bytes. SCons touches cache files when it retrieves them, so
+	mtime is the last use.
+	"""
+	files = []
+	total = 0
+	try:
+		entries = list(_entries(root))
+	except OSError:
+		return
+	for p in entries:
+		try:
+			st = os.stat(p)
+		except OSError:
+			continue
+		files.append((st.st_mtime, st.st_size, p))
+		total += st.st_size
+	files.sort()
+	for _, size, p in files:
+		if total <= limit:
+			break
+		try:
+			os.unlink(p)
+			total -= size
+		except OSError:
+			# Someone else (another CI worker) got to it first
+			pass
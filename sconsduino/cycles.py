@@ -0,0 +1,290 @@
+"""
+Best and worst case cycle counts for AVR interrupt handlers (and any other
+functions asked for), from objdump's disassembly of the linked ELF.
+
+Every path through a function is followed, using the instruction timings in
+the AVR instruction set manual for ATmega parts. Calls add the callee's
+cycles. Worst cases that can't be bounded (loops, recursion, indirect calls)
+are reported as unbounded. Interrupt handlers include the interrupt response
+and the jump in the vector table.
+"""
+from __future__ import absolute_import
+import re
+import json
+import heapq
+import subprocess
+
+_function = re.compile(r'^([0-9a-fA-F]+) <(.+)>:$')
+_insn = re.compile(r'^\s*([0-9a-fA-F]+):\t((?:[0-9a-fA-F]{2} )+)\s*\t(\S+)\s*([^;]*?)\s*(?:;\s*0x([0-9a-fA-F]+).*)?$')
+_isr = re.compile(r'^__vector_\d+$')
+
+# Cycles, where it isn't 1
+TIMINGS = {
+	'adiw': 2, 'sbiw': 2,
+	'mul': 2, 'muls': 2, 'mulsu': 2, 'fmul': 2, 'fmuls': 2, 'fmulsu': 2,
+	'ld': 2, 'ldd': 2, 'lds': 2, 'st': 2, 'std': 2, 'sts': 2,
+	'push': 2, 'pop': 2, 'sbi': 2, 'cbi': 2,
+	'lpm': 3, 'elpm': 3,
+	'rjmp': 2, 'ijmp': 2, 'eijmp': 2, 'jmp': 3,
+	'rcall': 3, 'icall': 3, 'eicall': 4, 'call': 4,
+	'ret': 4, 'reti': 4,
+}
+# One more cycle each with a 22-bit program counter (more than 128K of flash)
+PC22 = ('rcall', 'icall', 'call', 'ret', 'reti')
+PC22_MCUS = ('atmega2560', 'atmega2561')
+SKIPS = ('cpse', 'sbrc', 'sbrs', 'sbic', 'sbis')
+RETURNS = ('ret', 'reti')
+CALLS = ('call', 'rcall')
+JUMPS = ('jmp', 'rjmp')
+INDIRECT = ('icall', 'eicall', 'ijmp', 'eijmp')
+# Interrupt response (pushing the PC), before the vector's jmp
+RESPONSE = 4
+
+class Insn(object):
+	def __init__(self, addr, size, op, args, target):
+		self.addr = addr
+		self.size = size
+		self.op = op
+		self.args = args
+		self.target = target
+
+	@property
+	def next(self):
+		return self.addr + self.size
+
+def disassemble(objdump, elf):
+	"""
+	{name: [Insn]} and {address: name} for every function in the ELF.
+	"""
+	out = subprocess.Popen([objdump, '-d', '-C', elf], stdout=subprocess.PIPE).communicate()[0]
+	return parse(out)
+
+def parse(out):
+	funcs = {}
+	addrs = {}
+	insns = None
+	for line in out.splitlines():
+		m = _function.match(line)
+		if m:
+			insns = funcs.setdefault(m.group(2), [])
+			addrs.setdefault(int(m.group(1), 16), m.group(2))
+			continue
+		m = _insn.match(line)
+		if m and insns is not None:
+			target = m.group(5)
+			if target is None and m.group(4).startswith('0x'):
+				target = m.group(4)[2:]
+			insns.append(Insn(
+				int(m.group(1), 16), len(m.group(2).split()), m.group(3), m.group(4),
+				int(target, 16) if target is not None else None,
+			))
+	return funcs, addrs
+
+class Analysis(object):
+	def __init__(self, funcs, addrs, mcu):
+		self.funcs = funcs
+		self.addrs = addrs
+		self.pc22 = mcu in PC22_MCUS
+		self.memo = {}
+		self.notes = set()
+
+	def cost(self, op):
+		return TIMINGS.get(op, 1) + (1 if self.pc22 and op in PC22 else 0)
+
+	def edges(self, name, by_addr, i):
+		"""
+		[(next address or None for the end, cycles, callee)] out of i.
+		"""
+		op = i.op
+		if op in RETURNS:
+			return [(None, self.cost(op), None)]
+		if op.startswith('br') and op != 'break':
+			return [(i.next, 1, None), (i.target, 2, None)]
+		if op in SKIPS:
+			skipped = by_addr.get(i.next)
+			if skipped is None:
+				return [(i.next, 1, None)]
+			return [(i.next, 1, None), (skipped.next, 1 + skipped.size // 2, None)]
+		if op in JUMPS:
+			if i.target in by_addr:
+				return [(i.target, self.cost(op), None)]
+			# Tail call
+			return [(None, self.cost(op), i.target)]
+		if op in CALLS:
+			return [(i.next, self.cost(op), i.target)]
+		if op in INDIRECT:
+			self.notes.add("indirect call or jump in {}".format(name))
+			end = op.endswith('jmp')
+			return [(None if end else i.next, self.cost(op), False)]
+		return [(i.next, self.cost(op), None)]
+
+	def callee(self, addr):
+		"""
+		(best, worst) for a call to addr. worst is None if it's unbounded.
+		"""
+		if addr is False:
+			return 0, None
+		name = self.addrs.get(addr)
+		if name is None:
+			self.notes.add("call to unknown address 0x{:x}".format(addr))
+			return 0, None
+		return self.function(name)
+
+	def function(self, name):
+		"""
+		(best, worst) cycles for a function, from its first instruction up to and
+		including the return. worst is None if it's unbounded.
+		"""
+		if name in self.memo:
+			if self.memo[name] is None:
+				self.notes.add("recursion through {}".format(name))
+				return 0, None
+			return self.memo[name]
+		self.memo[name] = None
+		insns = self.funcs[name]
+		if not insns:
+			self.memo[name] = 0, 0
+			return self.memo[name]
+		by_addr = {i.addr: i for i in insns}
+		graph = {}
+		for i in insns:
+			out = []
+			for nxt, cycles, call in self.edges(name, by_addr, i):
+				best = worst = cycles
+				if call is not None:
+					cb, cw = self.callee(call)
+					best += cb
+					worst = None if cw is None else worst + cw
+				if nxt is not None and nxt not in by_addr:
+					# Falls out of the function; treat it as the end
+					nxt = None
+				out.append((nxt, best, worst))
+			graph[i.addr] = out
+		entry = insns[0].addr
+		self.memo[name] = self._best(graph, entry), self._worst(name, graph, entry)
+		return self.memo[name]
+
+	def _best(self, graph, entry):
+		# Dijkstra to the end
+		seen = set()
+		queue = [(0, entry)]
+		while queue:
+			d, n = heapq.heappop(queue)
+			if n is None:
+				return d
+			if n in seen:
+				continue
+			seen.add(n)
+			for nxt, best, _ in graph[n]:
+				heapq.heappush(queue, (d + best, nxt))
+		return 0
+
+	def _worst(self, name, graph, entry):
+		# Longest path, if there are no loops
+		order = []
+		state = {}
+		stack = [(entry, iter(graph[entry]))]
+		state[entry] = 1
+		while stack:
+			n, it = stack[-1]
+			for nxt, _, _ in it:
+				if nxt is None:
+					continue
+				if state.get(nxt) == 1:
+					self.notes.add("loop in {}".format(name))
+					return None
+				if nxt not in state:
+					state[nxt] = 1
+					stack.append((nxt, iter(graph[nxt])))
+					break
+			else:
+				state[n] = 2
+				order.append(n)
+				stack.pop()
+		longest = {}
+		for n in order:
+			best = 0
+			for nxt, _, worst in graph[n]:
+				if worst is None:
+					return None
+				best = max(best, worst + (longest[nxt] if nxt is not None else 0))
+			longest[n] = best
+		return longest[entry]
+
+def find(funcs, name):
+	"""
+	Functions match by their full (demangled) name, or without the arguments.
+	"""
+	for f in funcs:
+		if f == name or f.split('(')[0] == name:
+			return f
+
+def _us(cycles, hz):
+	return None if cycles is None or not hz else 1e6 * cycles / hz
+
+def _fmt(c):
+	return 'unbounded' if c is None else str(c)
+
+def report(target, source, env):
+	"""
+	SCons action: cycle counts for the interrupt handlers and $CYCLE_FUNCTIONS
+	in the ELF in source[0]. Writes JSON to target[0], comparing against what
+	was there before; fails if any worst case is over $CYCLE_LIMIT (in us), or
+	got slower and $CYCLE_STRICT is set.
+	"""
+	path = str(target[0])
+	try:
+		with open(path) as f:
+			old = json.load(f)['functions']
+	except (IOError, ValueError, KeyError):
+		old = {}
+	hz = env.get('CYCLE_F_CPU')
+	mcu = env.subst('$MCU')
+	funcs, addrs = disassemble(env.subst('$OBJDUMP'), str(source[0]))
+	a = Analysis(funcs, addrs, mcu)
+	overhead = RESPONSE + (1 if a.pc22 else 0) + a.cost('jmp')
+
+	names = sorted(f for f in funcs if _isr.match(f))
+	for n in env.get('CYCLE_FUNCTIONS', []):
+		f = find(funcs, n)
+		if f is None:
+			print "WARNING: No function {} to count cycles of".format(n)
+		elif f not in names:
+			names.append(f)
+
+	results = {}
+	errors = []
+	for n in names:
+		best, worst = a.function(n)
+		if _isr.match(n):
+			best += overhead
+			worst = None if worst is None else worst + overhead
+		r = results[n] = {'best': best, 'worst': worst, 'best_us': _us(best, hz), 'worst_us': _us(worst, hz)}
+		line = "  {}: {}-{} cycles".format(n, best, _fmt(worst))
+		if hz:
+			line += ", {:.2f}-{} us".format(r['best_us'], 'unbounded' if worst is None else '{:.2f}'.format(r['worst_us']))
+		prev = old.get(n)
+		if prev and (prev['best'], prev['worst']) != (best, worst):
+			line += " (was {}-{})".format(prev['best'], _fmt(prev['worst']))
+			slower = worst is None and prev['worst'] is not None or (
+				worst is not None and prev['worst'] is not None and worst > prev['worst'])
+			if slower and env.get('CYCLE_STRICT'):
+				errors.append("{} got slower".format(n))
+		print line
+		limit = env.get('CYCLE_LIMIT')
+		if limit is not None and hz and (worst is None or r['worst_us'] > limit):
+			errors.append("{} can take longer than {} us".format(n, limit))
+	for n in sorted(a.notes):
+		print "WARNING: cycle count is unbounded: {}".format(n)
+
+	with open(path, 'w') as f:
+		json.dump({
+			'elf': str(source[0]), 'mcu': mcu, 'f_cpu': hz, 'functions': results,
+			'notes': sorted(a.notes), 'errors': errors,
+		}, f, indent=2, sort_keys=True)
+	for e in errors:
+		print "ERROR: {}".format(e)
+	return 1 if errors else 0
+
+def describe(target, source, env):
+	return "Counting cycles in {}".format(source[0])
@@ -0,0 +1,38 @@
+"""
+Reading the make-style dependency files written by gcc -MMD.
+"""
+from __future__ import absolute_import
+import os
+
+def parse(path):
+	"""
+	Returns the prerequisites listed in a .d file, or None if it can't be read.
+	"""
+	try:
+		with open(path) as f:
+			text = f.read()
+	except IOError:
+		return None
+	text = text.replace('\\\n', ' ')
+	deps = []
+	for line in text.splitlines():
+		if ':' not in line:
+			continue
+		_, _, rest = line.partition(': ')
+		if not rest and line.endswith(':'):
+			# Phony target from -MP
+			continue
+		# Escaped spaces are the only escape gcc uses that we care about
+		parts = rest.replace('\\ ', '\0').split()
+		deps += [p.replace('\0', ' ') for p in parts]
+	return deps
+
+def deps(path):
+	"""
+	The existing files a .d lists, minus the source itself (the first entry).
+	None if there's no usable .d.
+	"""
+	d = parse(path)
+	if not d:
+		return None
+	return [p for p in d[1:] if os.path.exists(p)]
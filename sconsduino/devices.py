@@ -0,0 +1,141 @@
+"""
+Finding attached boards by USB vendor/product ID and serial number, from
+sysfs, without opening any ports.
+
+What's found is cached, keyed on the list of USB devices in sysfs and the
+modification time of /dev, so it's reread whenever anything is plugged in or
+unplugged.
+"""
+from __future__ import absolute_import
+import os
+import glob
+import json
+
+SYSFS = '/sys/bus/usb/devices'
+DEV = '/dev'
+
+# USB serial adapters and boards: (vid, pid)
+FTDI = [(0x0403, 0x6001), (0x0403, 0x6015)]
+CH340 = [(0x1a86, 0x7523)]
+CP210X = [(0x10c4, 0xea60)]
+UNO = [(0x2341, 0x0001), (0x2341, 0x0043), (0x2341, 0x0243), (0x2a03, 0x0043)]
+MEGA2560 = [(0x2341, 0x0010), (0x2341, 0x0042), (0x2341, 0x0242), (0x2a03, 0x0042)]
+# The HalfKay bootloader, then every USB type Teensyduino builds
+TEENSY = [(0x16c0, 0x0478)] + [(0x16c0, pid) for pid in range(0x0482, 0x048b)]
+
+class Device(object):
+	def __init__(self, path, vid, pid, serial=None, manufacturer=None, product=None, ports=()):
+		# Where it is in sysfs, eg 1-1.4
+		self.path = path
+		self.vid = vid
+		self.pid = pid
+		self.serial = serial
+		self.manufacturer = manufacturer
+		self.product = product
+		# Serial ports (/dev/ttyUSB0, ...), if it has any
+		self.ports = list(ports)
+
+	@property
+	def port(self):
+		return self.ports[0] if self.ports else None
+
+	def matches(self, ids=None, serial=None):
+		"""
+		ids - [(vid, pid)] it must be one of; pid may be None for any
+		serial - Serial number it must have
+		"""
+		if serial is not None and self.serial != serial:
+			return False
+		if ids is not None and not any(vid == self.vid and pid in (None, self.pid) for vid, pid in ids):
+			return False
+		return True
+
+	def __str__(self):
+		desc = "{:04x}:{:04x}".format(self.vid, self.pid)
+		if self.product:
+			desc += " " + self.product
+		if self.serial:
+			desc += " (serial {})".format(self.serial)
+		if self.ports:
+			desc += " on " + ', '.join(self.ports)
+		return desc
+
+	def to_json(self):
+		return dict(
+			path=self.path, vid=self.vid, pid=self.pid, serial=self.serial,
+			manufacturer=self.manufacturer, product=self.product, ports=self.ports,
+		)
+
+def _read(path):
+	try:
+		with open(path) as f:
+			return f.read().strip()
+	except IOError:
+		return None
+
+def read_sysfs(root=SYSFS, dev=DEV):
+	"""
+	[Device] for everything on the USB buses.
+	"""
+	devices = []
+	for d in sorted(glob.glob(os.path.join(root, '*'))):
+		vid = _read(os.path.join(d, 'idVendor'))
+		pid = _read(os.path.join(d, 'idProduct'))
+		if vid is None or pid is None:
+			# An interface or a hub port, not a device
+			continue
+		# cdc_acm puts the tty right under the interface; USB serial drivers
+		# add a level (1-1:1.0/ttyUSB0/tty/ttyUSB0)
+		ttys = set(os.path.basename(t) for t in
+			glob.glob(os.path.join(d, '*:*', 'tty', '*')) + glob.glob(os.path.join(d, '*:*', 'tty*', 'tty', '*')))
+		devices.append(Device(
+			os.path.basename(d), int(vid, 16), int(pid, 16),
+			serial=_read(os.path.join(d, 'serial')) or None,
+			manufacturer=_read(os.path.join(d, 'manufacturer')),
+			product=_read(os.path.join(d, 'product')),
+			ports=[os.path.join(dev, t) for t in sorted(ttys)],
+		))
+	return devices
+
+def _stamp(root, dev):
+	try:
+		names = sorted(os.listdir(root))
+	except OSError:
+		names = []
+	try:
+		mtime = os.stat(dev).st_mtime
+	except OSError:
+		mtime = None
+	return {'devices': names, 'dev': mtime}
+
+def scan(cache=None, root=SYSFS, dev=DEV):
+	"""
+	[Device] attached now, from the cache file if nothing's been plugged in or
+	out since it was written.
+	"""
+	stamp = _stamp(root, dev)
+	if cache is not None:
+		try:
+			with open(cache) as f:
+				cached = json.load(f)
+			if cached['stamp'] == stamp:
+				return [Device(**d) for d in cached['found']]
+		except (IOError, ValueError, KeyError, TypeError):
+			pass
+	found = read_sysfs(root, dev)
+	if cache is not None:
+		d = os.path.dirname(cache)
+		if d and not os.path.isdir(d):
+			os.makedirs(d)
+		tmp = "{}.{}.tmp".format(cache, os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump({'stamp': stamp, 'found': [x.to_json() for x in found]}, f)
+		os.rename(tmp, cache)
+	return found
+
+def find(devices, ids=None, serial=None, ports=False):
+	"""
+	The devices matching ids and serial (see Device.matches), and only the
+	ones with serial ports if ports is set.
+	"""
+	return [d for d in devices if d.matches(ids, serial) and (d.ports or not ports)]
@@ -0,0 +1,301 @@
+"""
+Distributed compilation, distcc-style.
+
+The client wraps compile commands: it preprocesses locally, sends the result
+to a worker, and writes back the object the worker returns. Anything that
+isn't a plain compile, or any failure to reach a worker or find a matching
+toolchain on it, runs locally instead.
+
+Workers only compile with toolchains they've been given, and only if the
+binary is identical (by MD5) to the client's. They only take requests from
+allowed hosts (just localhost by default), and only with code generation,
+optimization, debug, warning and define flags: anything else (-wrapper,
+-fplugin=, -specs=, @file, ...) could run arbitrary code on the worker.
+
+Run a worker with:
+	python -m sconsduino.distcc serve [--listen HOST:PORT] [--allow HOST,...] COMPILER...
+
+eg, on localhost:
+	python -m sconsduino.distcc serve /usr/share/arduino/hardware/tools/avr/bin/avr-g{cc,++}
+
+This file must not import the rest of sconsduino: SCons runs it as a script.
+"""
+import os
+import sys
+import json
+import socket
+import struct
+import hashlib
+import tempfile
+import subprocess
+import SocketServer
+
+DEFAULT_PORT = 3632
+CONNECT_TIMEOUT = 0.5
+COMPILE_TIMEOUT = 120
+
+# Options that only matter to the preprocessor
+CPP_OPTS = ('-I', '-D', '-U', '-include', '-imacros', '-isystem', '-iquote')
+# Options for the preprocessor that take a separate argument
+CPP_ARG_OPTS = ('-I', '-D', '-U', '-include', '-imacros', '-isystem', '-iquote', '-MF', '-MT', '-MQ')
+LANGS = {
+	'.c': 'cpp-output',
+	'.cpp': 'c++-cpp-output',
+}
+PREPROCESSED = {
+	'.c': '.i',
+	'.cpp': '.ii',
+}
+# Compile flags a worker accepts, by prefix (SAFE_PREFIXES) or exactly
+# (SAFE_FLAGS), unless they start with one of UNSAFE_PREFIXES
+SAFE_PREFIXES = ('-O', '-g', '-W', '-f', '-m', '-std=', '-D', '-U', '-pedantic')
+SAFE_FLAGS = ('-c', '-w', '-ansi', '-nostdlib', '-nostdinc')
+UNSAFE_PREFIXES = ('-Wl,', '-Wa,', '-Wp,', '-fplugin', '-fprofile', '-fauto-profile', '-fdump', '-fopt-info')
+DEFAULT_ALLOW = ('127.0.0.1',)
+
+def safe_args(args):
+	"""
+	Whether a worker can run a compile with args.
+	"""
+	return all(
+		isinstance(a, basestring) and (a in SAFE_FLAGS or a.startswith(SAFE_PREFIXES))
+		and not a.startswith(UNSAFE_PREFIXES)
+		for a in args
+	)
+
+def digest(path):
+	h = hashlib.md5()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 16), b''):
+			h.update(block)
+	return h.hexdigest()
+
+def send(sock, header, data=b''):
+	header = json.dumps(header)
+	sock.sendall(struct.pack('!II', len(header), len(data)) + header + data)
+
+def _recvall(sock, n):
+	buf = []
+	while n:
+		b = sock.recv(min(n, 1 << 16))
+		if not b:
+			raise IOError("Connection closed")
+		buf.append(b)
+		n -= len(b)
+	return b''.join(buf)
+
+def recv(sock):
+	hlen, dlen = struct.unpack('!II', _recvall(sock, 8))
+	return json.loads(_recvall(sock, hlen)), _recvall(sock, dlen)
+
+def parse_host(h):
+	host, _, port = h.partition(':')
+	return host, int(port or DEFAULT_PORT)
+
+
+class CompileJob(object):
+	"""
+	A gcc command line, split into the local preprocessing and remote compile
+	halves. .source is None if this isn't something we can distribute.
+	"""
+	def __init__(self, argv):
+		self.compiler = argv[0]
+		self.argv = argv
+		self.source = self.output = None
+		self.cpp_args = []
+		self.cc_args = []
+		args = argv[1:]
+		if '-c' not in args:
+			return
+		i = 0
+		while i < len(args):
+			a = args[i]
+			if a == '-o':
+				self.output = args[i+1]
+				i += 2
+				continue
+			if a in CPP_ARG_OPTS:
+				self.cpp_args += args[i:i+2]
+				i += 2
+				continue
+			if a.startswith(CPP_OPTS) or a.startswith('-M') or a == '-Winvalid-pch':
+				self.cpp_args.append(a)
+			elif not a.startswith('-') and os.path.splitext(a)[1] in LANGS:
+				if self.source is not None:
+					# Multiple sources
+					self.source = None
+					return
+				self.source = a
+			else:
+				self.cc_args.append(a)
+				# Machine and language flags affect preprocessing too
+				if a != '-c':
+					self.cpp_args.append(a)
+			i += 1
+		if self.output is None:
+			self.source = None
+
+	@property
+	def ext(self):
+		return os.path.splitext(self.source)[1]
+
+	def preprocess(self):
+		"""
+		Runs the preprocessor locally (which also writes any -MMD dependency
+		file). Returns the preprocessed source, or None if it failed.
+		"""
+		# Name the dependency file's target after the object, not the .i
+		deps = ['-MT', self.output] if any(a.startswith('-M') for a in self.cpp_args) else []
+		p = subprocess.Popen(
+			[self.compiler, '-E'] + self.cpp_args + deps + [self.source],
+			stdout=subprocess.PIPE,
+		)
+		out = p.communicate()[0]
+		if p.returncode:
+			return None
+		return out
+
+	def request(self):
+		return {
+			'tool': os.path.basename(self.compiler),
+			'digest': digest(self.compiler),
+			'args': self.cc_args,
+			'lang': LANGS[self.ext],
+			'suffix': PREPROCESSED[self.ext],
+		}
+
+
+def run_remote(job, hosts):
+	"""
+	Compile job on one of hosts. Returns the return code, or None if no
+	worker could do it.
+	"""
+	if not hosts:
+		return None
+	pre = job.preprocess()
+	if pre is None:
+		return None
+	req = job.request()
+	# Spread jobs from parallel builds over the hosts
+	start = os.getpid() % len(hosts)
+	for h in hosts[start:] + hosts[:start]:
+		try:
+			sock = socket.create_connection(parse_host(h), CONNECT_TIMEOUT)
+		except (socket.error, ValueError):
+			continue
+		try:
+			sock.settimeout(COMPILE_TIMEOUT)
+			send(sock, req, pre)
+			resp, obj = recv(sock)
+		except (socket.error, IOError, ValueError):
+			continue
+		finally:
+			sock.close()
+		if resp.get('error'):
+			# Eg, no matching toolchain; another worker might have it
+			continue
+		# Unicode, from JSON; gcc's quotes don't encode as ASCII when piped
+		sys.stderr.write(resp.get('stderr', u'').encode('utf-8'))
+		if resp['returncode'] == 0:
+			with open(job.output, 'wb') as f:
+				f.write(obj)
+			if 'stack_usage' in resp:
+				with open(os.path.splitext(job.output)[0]+'.su', 'w') as f:
+					f.write(resp['stack_usage'])
+		return resp['returncode']
+	return None
+
+def client(argv, hosts):
+	job = CompileJob(argv)
+	if job.source is not None:
+		rc = run_remote(job, hosts)
+		if rc is not None:
+			return rc
+	return subprocess.call(argv)
+
+
+class Worker(SocketServer.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+	def __init__(self, addr, compilers, allow=DEFAULT_ALLOW):
+		# (MD5, name) -> path, so the client's toolchain can be matched exactly
+		self.compilers = {(digest(c), os.path.basename(c)): os.path.abspath(c) for c in compilers}
+		self.allow = set(socket.gethostbyname(h) for h in allow)
+		SocketServer.ThreadingTCPServer.__init__(self, addr, WorkerHandler)
+
+	def verify_request(self, request, client_address):
+		return client_address[0] in self.allow
+
+class WorkerHandler(SocketServer.BaseRequestHandler):
+	def handle(self):
+		try:
+			req, src = recv(self.request)
+		except (IOError, ValueError, struct.error):
+			return
+		compiler = self.server.compilers.get((req.get('digest'), req.get('tool')))
+		if compiler is None:
+			send(self.request, {'error': "No matching toolchain for {}".format(req.get('tool'))})
+			return
+		args = req.get('args')
+		if (not isinstance(args, list) or not safe_args(args)
+				or req.get('lang') not in LANGS.values() or req.get('suffix') not in PREPROCESSED.values()):
+			send(self.request, {'error': "Refusing to compile with {!r}".format(args)})
+			return
+		d = tempfile.mkdtemp(prefix='sconsduino-distcc-')
+		try:
+			inp = os.path.join(d, 'job'+req['suffix'])
+			out = os.path.join(d, 'job.o')
+			with open(inp, 'wb') as f:
+				f.write(src)
+			p = subprocess.Popen(
+				[compiler, '-x', req['lang']] + args + ['-o', out, inp],
+				stderr=subprocess.PIPE, cwd=d,
+			)
+			err = p.communicate()[1]
+			resp = {'returncode': p.returncode, 'stderr': err.decode('utf-8', 'replace')}
+			obj = b''
+			if p.returncode == 0:
+				with open(out, 'rb') as f:
+					obj = f.read()
+				# -fstack-usage output goes back with the object
+				su = os.path.join(d, 'job.su')
+				if os.path.exists(su):
+					with open(su) as f:
+						resp['stack_usage'] = f.read()
+			send(self.request, resp, obj)
+		finally:
+			for fn in os.listdir(d):
+				os.unlink(os.path.join(d, fn))
+			os.rmdir(d)
+
+def serve(argv):
+	addr = '127.0.0.1:{}'.format(DEFAULT_PORT)
+	allow = list(DEFAULT_ALLOW)
+	while argv[:1] in (['--listen'], ['--allow']) and len(argv) > 1:
+		if argv[0] == '--listen':
+			addr = argv[1]
+		else:
+			allow += [h for h in argv[1].split(',') if h]
+		argv = argv[2:]
+	if not argv:
+		sys.exit("Usage: serve [--listen HOST:PORT] [--allow HOST,...] COMPILER...")
+	w = Worker(parse_host(addr), argv, allow)
+	print "Serving {} on {} to {}".format(', '.join(sorted(w.compilers.values())), addr, ', '.join(sorted(w.allow)))
+	w.serve_forever()
+
+def main(argv):
+	"""
+	serve ... - Run a worker
+	compile HOSTS -- COMPILER ARGS... - Compile, remotely if possible (HOSTS is
+	comma-separated)
+	"""
+	if argv[:1] == ['serve']:
+		serve(argv[1:])
+	elif argv[:1] == ['compile'] and len(argv) > 3 and argv[2] == '--':
+		sys.exit(client(argv[3:], [h for h in argv[1].split(',') if h]))
+	else:
+		sys.exit(main.__doc__)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,245 @@
+"""
+Just enough of an ELF reader to turn linked firmware into flashable images,
+without objcopy.
+
+Only 32-bit ELF (AVR and Cortex-M) is supported.
+"""
+from __future__ import absolute_import
+import struct
+import os
+
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+STT_OBJECT = 1
+STT_FUNC = 2
+
+class Section(object):
+	def __init__(self, name, type, flags, addr, offset, size, link=0, entsize=0):
+		self.name = name
+		self.type = type
+		self.flags = flags
+		self.addr = addr
+		self.offset = offset
+		self.size = size
+		self.link = link
+		self.entsize = entsize
+
+	@property
+	def loadable(self):
+		"""
+		What objcopy calls SEC_LOAD: allocated, with contents in the file.
+		"""
+		return bool(self.flags & SHF_ALLOC) and self.type != SHT_NOBITS and self.size > 0
+
+class Segment(object):
+	def __init__(self, type, offset, vaddr, paddr, filesz, memsz):
+		self.type = type
+		self.offset = offset
+		self.vaddr = vaddr
+		self.paddr = paddr
+		self.filesz = filesz
+		self.memsz = memsz
+
+class Symbol(object):
+	def __init__(self, name, value, size, type, section):
+		self.name = name
+		self.value = value
+		self.size = size
+		self.type = type
+		# Section name, or None for absolute/undefined/common symbols
+		self.section = section
+
+class ELF(object):
+	def __init__(self, data):
+		if data[:4] != b'\x7fELF':
+			raise ValueError("Not an ELF file")
+		if ord(data[4:5]) != 1:
+			raise ValueError("Only 32-bit ELF is supported")
+		self.data = data
+		self.endian = '<' if ord(data[5:6]) == 1 else '>'
+		(self.type, self.machine, _, self.entry, phoff, shoff, self.flags, _,
+			phentsize, phnum, shentsize, shnum, shstrndx) = self._unpack('HHIIIIIHHHHHH', 16)
+
+		self.segments = []
+		for i in range(phnum):
+			p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, _, _ = self._unpack('IIIIIIII', phoff + i*phentsize)
+			self.segments.append(Segment(p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz))
+
+		raw = [self._unpack('IIIIIIIIII', shoff + i*shentsize) for i in range(shnum)]
+		strtab = raw[shstrndx][4] if shnum else 0
+		self.sections = [
+			Section(self._str(strtab, s[0]), s[1], s[2], s[3], s[4], s[5], s[6], s[9])
+			for s in raw
+		]
+
+	@classmethod
+	def load(cls, path):
+		with open(path, 'rb') as f:
+			return cls(f.read())
+
+	def _unpack(self, fmt, offset):
+		return struct.unpack_from(self.endian+fmt, self.data, offset)
+
+	def _str(self, table, offset):
+		start = table + offset
+		return self.data[start:self.data.index(b'\0', start)].decode('ascii', 'replace')
+
+	def section(self, name):
+		for s in self.sections:
+			if s.name == name:
+				return s
+
+	def symbols(self):
+		"""
+		The functions and data objects in the symbol table.
+		"""
+		syms = []
+		for st in self.sections:
+			if st.type != SHT_SYMTAB or not st.entsize:
+				continue
+			names = self.sections[st.link].offset
+			for off in range(st.offset, st.offset + st.size, st.entsize):
+				name, value, size, info, _, shndx = self._unpack('IIIBBH', off)
+				if info & 0xF not in (STT_OBJECT, STT_FUNC):
+					continue
+				section = self.sections[shndx].name if 0 < shndx < len(self.sections) else None
+				syms.append(Symbol(self._str(names, name), value, size, info & 0xF, section))
+		return syms
+
+	def contents(self, section):
+		return bytearray(self.data[section.offset:section.offset+section.size])
+
+	def lma(self, section):
+		"""
+		The load address of a section: where it goes in flash, which differs from
+		its address for initialized data.
+		"""
+		for seg in self.segments:
+			if seg.type == PT_LOAD and seg.offset <= section.offset and section.offset + section.size <= seg.offset + seg.filesz:
+				return seg.paddr + section.offset - seg.offset
+		return section.addr
+
+	def image(self, exclude=(), only=None, lma=None):
+		"""
+		Returns [(address, bytearray)] of the loadable sections, by load address.
+
+		exclude - Section names to leave out
+		only - Section names to keep (instead of all of them)
+		lma - Load address to use instead (for a single section)
+		"""
+		chunks = []
+		for s in self.sections:
+			if not s.loadable or s.name in exclude or (only is not None and s.name not in only):
+				continue
+			chunks.append((self.lma(s) if lma is None else lma, self.contents(s)))
+		chunks.sort(key=lambda c: c[0])
+		return chunks
+
+def ihex(chunks, start=0, width=16):
+	"""
+	Intel HEX text for [(address, bytearray)], laid out the way objcopy does:
+	segment address records below 1M, linear ones above, and a start address
+	record if start isn't 0.
+	"""
+	def record(type, addr, data=bytearray()):
+		rec = bytearray([len(data), (addr >> 8) & 0xFF, addr & 0xFF, type]) + data
+		return ":{}{:02X}\r\n".format(''.join('{:02X}'.format(b) for b in rec), (-sum(rec)) & 0xFF)
+
+	def be(v, n):
+		return bytearray((v >> (8*i)) & 0xFF for i in reversed(range(n)))
+
+	out = []
+	segbase = extbase = 0
+	for addr, data in chunks:
+		i = 0
+		while i < len(data):
+			a = addr + i
+			if a > segbase + extbase + 0xFFFF:
+				if a <= 0xFFFFF:
+					segbase = a & 0xF0000
+					out.append(record(0x02, 0, be(segbase >> 4, 2)))
+				else:
+					if segbase:
+						segbase = 0
+						out.append(record(0x02, 0, be(0, 2)))
+					extbase = a & 0xFFFF0000
+					out.append(record(0x04, 0, be(extbase >> 16, 2)))
+			# Records can't cross a 64K boundary
+			n = min(width, len(data) - i, segbase + extbase + 0x10000 - a)
+			out.append(record(0x00, (a - segbase - extbase) & 0xFFFF, data[i:i+n]))
+			i += n
+	if start:
+		if start <= 0xFFFFF:
+			out.append(record(0x03, 0, be((start & 0xF0000) >> 4, 2) + be(start & 0xFFFF, 2)))
+		else:
+			out.append(record(0x05, 0, be(start, 4)))
+	out.append(record(0x01, 0))
+	return ''.join(out)
+
+def read_ihex(text):
+	"""
+	[(address, bytearray)] from Intel HEX text, with adjacent records joined.
+	"""
+	chunks = []
+	base = 0
+	for line in text.splitlines():
+		line = line.strip()
+		if not line.startswith(':'):
+			continue
+		rec = bytearray.fromhex(line[1:])
+		if sum(rec) & 0xFF:
+			raise ValueError("Bad checksum in {!r}".format(line))
+		n, addr, type, data = rec[0], (rec[1] << 8) | rec[2], rec[3], rec[4:4+rec[0]]
+		if type == 0x00:
+			a = base + addr
+			if chunks and chunks[-1][0] + len(chunks[-1][1]) == a:
+				chunks[-1][1].extend(data)
+			else:
+				chunks.append((a, bytearray(data)))
+		elif type == 0x01:
+			break
+		elif type == 0x02:
+			base = ((data[0] << 8) | data[1]) << 4
+		elif type == 0x04:
+			base = ((data[0] << 8) | data[1]) << 16
+	chunks.sort(key=lambda c: c[0])
+	return chunks
+
+def binary(chunks, fill=0):
+	"""
+	A raw image from the lowest address to the highest, gaps filled.
+	"""
+	if not chunks:
+		return bytearray()
+	base = chunks[0][0]
+	out = bytearray()
+	for addr, data in chunks:
+		out.extend([fill] * (addr - base - len(out)))
+		out.extend(data)
+	return out
+
+def images(target, source, env):
+	"""
+	SCons action: write flash and EEPROM images for the ELF in source[0], to
+	each target by extension: .hex (flash), .eep (EEPROM at address 0), .bin
+	(raw flash).
+	"""
+	e = ELF.load(str(source[0]))
+	flash = e.image(exclude=['.eeprom'])
+	for t in target:
+		ext = os.path.splitext(str(t))[1]
+		if ext == '.hex':
+			data = ihex(flash, e.entry)
+		elif ext == '.eep':
+			data = ihex(e.image(only=['.eeprom'], lma=0), e.entry)
+		elif ext == '.bin':
+			data = bytes(binary(flash))
+		else:
+			raise ValueError("Don't know how to make {}".format(t))
+		with open(str(t), 'wb') as f:
+			f.write(data)
+
+def describe(target, source, env):
+	return "Writing {} from {}".format(', '.join(str(t) for t in target), source[0])
@@ -0,0 +1,109 @@
+"""
+Flashing the same image to a batch of boards at once.
+
+Devices are serial ports, or USB serial numbers looked up in
+/dev/serial/by-id.
+Each device gets its own worker and is retried on its own if it fails.
+"""
+from __future__ import absolute_import
+import os
+import glob
+import json
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_RETRIES = 2
+BY_ID = '/dev/serial/by-id'
+
+def resolve(device):
+	"""
+	The port for a device: a path as is, or a USB serial number. None if it
+	isn't attached.
+	"""
+	if os.path.exists(device):
+		return device
+	for p in sorted(glob.glob(os.path.join(BY_ID, '*'))):
+		# eg, usb-FTDI_FT232R_USB_UART_A600XYZ1-if00-port0
+		if device in os.path.basename(p).split('_')[-1].split('-'):
+			return p
+
+def flash_all(devices, flash, workers=None, retries=DEFAULT_RETRIES, errors=(EnvironmentError,), log=None):
+	"""
+	Call flash(port) for every device in parallel, retrying each up to retries
+	times when it raises one of errors. Returns a result dict per device, in
+	order.
+	"""
+	lock = threading.Lock()
+
+	def one(device):
+		start = time.time()
+		r = {'device': device, 'port': resolve(device), 'ok': False, 'attempts': 0, 'error': None}
+		if r['port'] is None:
+			r['error'] = "Not attached"
+		else:
+			while not r['ok'] and r['attempts'] <= retries:
+				r['attempts'] += 1
+				try:
+					flash(r['port'])
+				except errors as e:
+					r['error'] = str(e)
+				else:
+					r['ok'] = True
+					r['error'] = None
+		r['seconds'] = time.time() - start
+		if log is not None:
+			with lock:
+				log(_line(r))
+		return r
+
+	pool = ThreadPool(workers or len(devices))
+	try:
+		return pool.map(one, devices)
+	finally:
+		pool.close()
+		pool.join()
+
+def _line(r):
+	line = "  {:40} {:6} {:5.1f}s".format(r['device'], 'ok' if r['ok'] else 'FAILED', r['seconds'])
+	if r['attempts'] > 1:
+		line += " ({} attempts)".format(r['attempts'])
+	if r['error']:
+		line += ": {}".format(r['error'])
+	return line
+
+
+class Farm(object):
+	"""
+	SCons action: flash source[0] to every device with flash(port, hexfile),
+	and write a JSON report to target[0]. Fails if any device failed.
+	"""
+	def __init__(self, devices, flash, workers=None, retries=DEFAULT_RETRIES, errors=(EnvironmentError,)):
+		self.devices = devices
+		self.flash = flash
+		self.workers = workers
+		self.retries = retries
+		self.errors = errors
+
+	def __call__(self, target, source, env):
+		devices = self.devices() if callable(self.devices) else self.devices
+		if not devices:
+			print "ERROR: No boards to flash; name them with board.farm(), SCONSDUINO_FARM or FARM_DEVICES"
+			return 1
+		hexfile = str(source[0])
+		start = time.time()
+		results = flash_all(
+			devices, lambda port: self.flash(port, hexfile),
+			workers=self.workers, retries=self.retries, errors=self.errors, log=_print,
+		)
+		ok = sum(1 for r in results if r['ok'])
+		print "Flashed {} of {} boards in {:.1f}s".format(ok, len(results), time.time() - start)
+		with open(str(target[0]), 'w') as f:
+			json.dump({'hex': hexfile, 'seconds': time.time() - start, 'devices': results}, f, indent=2, sort_keys=True)
+		return 0 if ok == len(results) else 1
+
+	def describe(self, target, source, env):
+		return "Flashing {} to every board".format(source[0])
+
+def _print(msg):
+	print msg
@@ -0,0 +1,180 @@
+"""
+Per-symbol and per-object size history, to find what made firmware grow.
+
+Symbol sizes come from the ELF symbol table, object sizes from the linker map
+(-Wl,-Map). Every build is added to a JSON history in the user cache and
+compared against the build before it, and against the baseline if there is
+one. Build with SCONSDUINO_SIZE_BASELINE=1 to make that build the baseline.
+"""
+from __future__ import absolute_import
+import os
+import re
+import json
+import time
+from . import size, elf as elffile
+
+# Builds kept in the history
+KEEP = 20
+# Contributors printed
+TOP = 10
+
+_input_section = re.compile(r'^ (\.\S+)\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)\s+(\S.*)$')
+_input_name = re.compile(r'^ (\.\S+)$')
+_input_rest = re.compile(r'^\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)\s+(\S.*)$')
+_output_section = re.compile(r'^(\S+)')
+_archive = re.compile(r'^(.*?)\((.*)\)$')
+_ltrans = re.compile(r'.*\.ltrans\d*\.ltrans\.o$')
+
+def regions(section):
+	"""
+	What memory a section takes: flash, RAM, both (initialized data) or neither.
+	"""
+	if section in size.TEXT_SECTIONS:
+		return ('flash',)
+	if section in size.DATA_SECTIONS:
+		return ('flash', 'ram')
+	if section in size.BSS_SECTIONS:
+		return ('ram',)
+	return ()
+
+def _add(sizes, key, section, n):
+	for r in regions(section):
+		d = sizes.setdefault(key, {})
+		d[r] = d.get(r, 0) + n
+
+def symbol_sizes(path):
+	"""
+	{symbol: {region: bytes}} from an ELF. Same-named (static) symbols are
+	added together.
+	"""
+	sizes = {}
+	for s in elffile.ELF.load(path).symbols():
+		if s.size and s.section:
+			_add(sizes, s.name, s.section, s.size)
+	return sizes
+
+def object_name(path, strip=''):
+	"""
+	A name for an object that stays the same between builds: relative to the
+	build variant, or archive(member), or (lto) for link-time code.
+	"""
+	m = _archive.match(path)
+	if m:
+		return "{}({})".format(os.path.basename(m.group(1)), m.group(2))
+	if _ltrans.match(path):
+		return '(lto)'
+	if strip and path.startswith(strip):
+		return path[len(strip):].lstrip('/')
+	return path
+
+def object_sizes(path, strip=''):
+	"""
+	{object: {region: bytes}} from a GNU ld map file.
+	"""
+	sizes = {}
+	output = None
+	pending = None
+	started = False
+	with open(path) as f:
+		for line in f:
+			line = line.rstrip('\r\n')
+			if not started:
+				started = line.startswith('Linker script and memory map')
+				continue
+			if pending is not None:
+				m = _input_rest.match(line)
+				if m:
+					_add(sizes, object_name(m.group(3).strip(), strip), output, int(m.group(2), 16))
+				pending = None
+				continue
+			m = _input_section.match(line)
+			if m:
+				_add(sizes, object_name(m.group(4).strip(), strip), output, int(m.group(3), 16))
+				continue
+			m = _input_name.match(line)
+			if m:
+				# Long section names put the address and size on the next line
+				pending = m.group(1)
+				continue
+			m = _output_section.match(line)
+			if m:
+				output = m.group(1)
+	return sizes
+
+def growth(old, new):
+	"""
+	[(bytes, name, region)] of everything that changed, biggest growth first.
+	"""
+	changes = []
+	for name in set(old) | set(new):
+		o, n = old.get(name, {}), new.get(name, {})
+		for r in ('flash', 'ram'):
+			d = n.get(r, 0) - o.get(r, 0)
+			if d:
+				changes.append((d, name, r))
+	changes.sort(key=lambda c: (-c[0], c[1], c[2]))
+	return changes
+
+def _compare(label, old, new, top):
+	if not growth(old['symbols'], new['symbols']) and not growth(old['objects'], new['objects']):
+		print "No size changes since {}".format(label)
+		return
+	print "Size changes since {}:".format(label)
+	for r in ('flash', 'ram'):
+		total = sum(s.get(r, 0) for s in new['symbols'].values()) - sum(s.get(r, 0) for s in old['symbols'].values())
+		print "  {} {:+d} bytes (in symbols)".format(r, total)
+	for kind in ('objects', 'symbols'):
+		for d, name, r in [c for c in growth(old[kind], new[kind]) if c[0] > 0][:top]:
+			print "  {:+6d} {:5} {}".format(d, r, name)
+
+def load(path):
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {'baseline': None, 'builds': []}
+
+def save(path, db):
+	d = os.path.dirname(path)
+	if d and not os.path.isdir(d):
+		os.makedirs(d)
+	tmp = "{}.{}.tmp".format(path, os.getpid())
+	with open(tmp, 'w') as f:
+		json.dump(db, f)
+	os.rename(tmp, path)
+
+def track(target, source, env):
+	"""
+	SCons action: record the sizes of the ELF in source[0] (and its .map) in
+	the history at $SIZE_HISTORY, write them to target[0] and print what grew.
+	If $SIZE_HISTORY_BASELINE is set, this build becomes the baseline.
+	"""
+	elf = str(source[0])
+	strip = env.subst('$SIZE_HISTORY_STRIP')
+	snap = {
+		'time': time.time(),
+		'symbols': symbol_sizes(elf),
+		'objects': {},
+	}
+	mapfile = os.path.splitext(elf)[0] + '.map'
+	if os.path.exists(mapfile):
+		snap['objects'] = object_sizes(mapfile, strip)
+
+	path = env.subst('$SIZE_HISTORY')
+	db = load(path)
+	top = env.get('SIZE_HISTORY_TOP', TOP)
+	if db['builds']:
+		_compare('last build', db['builds'][-1], snap, top)
+	if db['baseline']:
+		_compare('baseline', db['baseline'], snap, top)
+	if env.get('SIZE_HISTORY_BASELINE'):
+		print "Saving {} as the size baseline".format(elf)
+		db['baseline'] = snap
+	db['builds'] = (db['builds'] + [snap])[-KEEP:]
+	save(path, db)
+
+	with open(str(target[0]), 'w') as f:
+		json.dump(snap, f, indent=2, sort_keys=True)
+
+def describe(target, source, env):
+	return "Recording symbol sizes of {}".format(source[0])
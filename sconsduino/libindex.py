@@ -0,0 +1,155 @@
+"""
+Finds the libraries a sketch needs by following its #includes.
+
+Two things are kept on disk (CACHE_DIR/libindex.json), both keyed on mtimes so
+they update incrementally:
+* the headers each library provides (keyed on every directory looked in)
+* the #includes of each source file scanned
+
+Quoted includes that exist next to the including file, or in one of the
+sketch's own directories, are the sketch's and never pull in a library.
+
+Directory listings come from the shared scan cache.
+"""
+from __future__ import absolute_import
+import os
+import re
+import json
+
+INCLUDE = re.compile(r'^\s*#\s*include\s*([<"])([^>"]+)[>"]', re.M)
+HEADER_EXTS = ('.h', '.hh', '.hpp')
+SOURCE_EXTS = ('.c', '.cpp', '.h', '.hh', '.hpp', '.ino')
+# Bumped when what's stored changes
+VERSION = 2
+
+class LibraryIndex(object):
+	def __init__(self, path, scancache, search_paths):
+		"""
+		path - Where to keep the index
+		scancache - A scan.ScanCache
+		search_paths - Directories containing libraries, highest priority first
+		"""
+		self.path = path
+		self.scan = scancache
+		self.search_paths = [os.path.abspath(p) for p in search_paths]
+		self.dirty = False
+		self.libs = {}
+		self.includes = {}
+		try:
+			with open(path) as f:
+				data = json.load(f)
+			if data.get('version') != VERSION:
+				raise ValueError("Old index")
+			self.libs = data['libs']
+			self.includes = data['includes']
+		except (IOError, ValueError, KeyError):
+			pass
+		self._headers = None
+
+	def _lib_headers(self, lib):
+		"""
+		Headers a library provides: those in its root, and in src/ (1.5 layout).
+		"""
+		dirs = [lib, os.path.join(lib, 'src')]
+		stamps = [os.stat(d).st_mtime if os.path.isdir(d) else None for d in dirs]
+		entry = self.libs.get(lib)
+		if entry is not None and entry[0] == stamps:
+			return entry[1]
+		headers = []
+		for d, stamp in zip(dirs, stamps):
+			if stamp is not None:
+				headers += [fn for fn in self.scan.listdir(d)[1] if fn.endswith(HEADER_EXTS)]
+		self.libs[lib] = [stamps, headers]
+		self.dirty = True
+		return headers
+
+	def headers(self):
+		"""
+		Map of header name to library directory.
+		"""
+		if self._headers is None:
+			self._headers = {}
+			for sp in self.search_paths:
+				try:
+					dns, _ = self.scan.listdir(sp)
+				except OSError:
+					continue
+				for dn in dns:
+					lib = os.path.join(sp, dn)
+					for h in self._lib_headers(lib):
+						self._headers.setdefault(h, lib)
+		return self._headers
+
+	def file_includes(self, fn):
+		"""
+		Everything fn #includes, as (quote, name): quote is '"' or '<'.
+		"""
+		mtime = os.stat(fn).st_mtime
+		entry = self.includes.get(fn)
+		if entry is not None and entry[0] == mtime:
+			return entry[1]
+		with open(fn) as f:
+			incs = INCLUDE.findall(f.read())
+		self.includes[fn] = [mtime, incs]
+		self.dirty = True
+		return incs
+
+	def _local(self, fn, inc, local_dirs):
+		"""
+		Whether a quoted include in fn is one of the sketch's own headers.
+		"""
+		dirs = [os.path.dirname(fn)] + list(local_dirs)
+		return any(os.path.exists(os.path.join(d, inc)) for d in dirs)
+
+	def lib_files(self, lib):
+		for d, dns, fns in self.scan.walk(lib):
+			if 'examples' in dns:
+				dns.remove('examples')
+			for fn in fns:
+				if fn.endswith(SOURCE_EXTS):
+					yield os.path.join(d, fn)
+
+	def resolve(self, files, known=(), local_dirs=()):
+		"""
+		Follow the #includes in files, and the libraries they pull in, and return
+		the library directories needed, in the order they were found. Libraries in
+		known are scanned, but not returned. Quoted includes found in local_dirs
+		(the sketch's) aren't looked up in the libraries.
+		"""
+		headers = self.headers()
+		found = []
+		seen = set(os.path.abspath(k) for k in known)
+		todo = list(files)
+		for k in seen:
+			todo += self.lib_files(k)
+		scanned = set()
+		while todo:
+			fn = todo.pop()
+			if fn in scanned:
+				continue
+			scanned.add(fn)
+			for quote, inc in self.file_includes(fn):
+				if quote == '"' and self._local(fn, inc, local_dirs):
+					continue
+				lib = headers.get(inc)
+				if lib is None or lib in seen:
+					continue
+				seen.add(lib)
+				found.append(lib)
+				todo += self.lib_files(lib)
+		self.save()
+		return found
+
+	def save(self):
+		if not self.dirty:
+			return
+		tmp = "{}.{}.tmp".format(self.path, os.getpid())
+		try:
+			if not os.path.isdir(os.path.dirname(self.path)):
+				os.makedirs(os.path.dirname(self.path))
+			with open(tmp, 'w') as f:
+				json.dump({'version': VERSION, 'libs': self.libs, 'includes': self.includes}, f)
+			os.rename(tmp, self.path)
+			self.dirty = False
+		except (IOError, OSError):
+			pass
@@ -2,8 +2,34 @@
 Module to work with the NanoPB library.
 
 Why? Because I use it.
+
+Every .proto added is generated by one protoc run, since starting protoc and
+the Python plugin costs more than generating. Generated code is cached in
+the user cache, keyed on the .proto (with its .options and whatever it
+imports), the nanopb version and $PROTOFLAGS, so only protos that changed
+are actually given to protoc.
+
+The runtime (pb_encode.c, ...) is archived once per board configuration, like
+the core. report() adds a report of each message's largest encoded size and
+its struct's size on the board.
 """
+from __future__ import absolute_import
 import os.path
+import re
+import shutil
+import tempfile
+import json
+import struct
+import subprocess
+from . import cache
+from . import elf
+
+_import = re.compile(r'^\s*import\s+(?:public\s+|weak\s+)?"([^"]+)"\s*;', re.M)
+_version = re.compile(r'nanopb_version\s*=\s*"([^"]+)"')
+_message = re.compile(r'^typedef struct _(\w+) \{', re.M)
+# Symbols in the size probe
+STRUCT_PREFIX = 'sconsduino_pb_struct_'
+ENCODED_PREFIX = 'sconsduino_pb_encoded_'
 
 
 """
@@ -28,6 +54,207 @@ teensy.add_generator(npb)
 teensy.sketch('blinky')
 """
 
+def nanopb_version(nanopb):
+	"""
+	The nanopb version, from its generator (or a hash of the generator if it
+	doesn't say).
+	"""
+	gen = os.path.join(nanopb, 'generator', 'nanopb_generator.py')
+	try:
+		with open(gen) as f:
+			m = _version.search(f.read())
+	except IOError:
+		return ''
+	return m.group(1) if m else cache.file_digest(gen)
+
+def imports(path, proto_path):
+	"""
+	Every .proto path imports, directly or not, that's under proto_path.
+	"""
+	found = []
+	todo = [path]
+	while todo:
+		try:
+			with open(todo.pop()) as f:
+				text = f.read()
+		except IOError:
+			continue
+		for name in _import.findall(text):
+			p = os.path.join(proto_path, name)
+			if p not in found and os.path.exists(p):
+				found.append(p)
+				todo.append(p)
+	return found
+
+def options_file(proto):
+	"""
+	The .options file the generator reads for proto, if there is one.
+	"""
+	opts = os.path.splitext(proto)[0] + '.options'
+	return opts if os.path.exists(opts) else None
+
+def dependencies(path, proto_path):
+	"""
+	What the code generated for path depends on: it, what it imports, and
+	their .options files.
+	"""
+	protos = [path] + imports(path, proto_path)
+	return protos + [o for o in map(options_file, protos) if o is not None]
+
+class Generate(object):
+	"""
+	SCons action: generate .pb.c and .pb.h for every proto (relative to
+	proto_path) into out_dir, with one protoc run for all those not in the
+	cache.
+	"""
+	def __init__(self, protos, proto_path, out_dir, cache_dir):
+		self.protos = protos
+		self.proto_path = proto_path
+		self.out_dir = out_dir
+		self.cache_dir = cache_dir
+
+	def key(self, proto, env):
+		deps = dependencies(os.path.join(self.proto_path, proto), self.proto_path)
+		return cache.fingerprint(
+			proto, nanopb_version(env.subst('$NANOPB')), env.subst('$PROTOFLAGS'),
+			*[os.path.relpath(d, self.proto_path) + ':' + cache.file_digest(d) for d in deps]
+		)
+
+	def __call__(self, target, source, env):
+		keys = {p: self.key(p, env) for p in self.protos}
+		todo = [p for p in self.protos if not all(
+			os.path.exists(os.path.join(self.cache_dir, keys[p], f)) for f in _outputs(p))]
+		if todo:
+			tmp = tempfile.mkdtemp(dir=self.out_dir)
+			try:
+				cmd = [
+					env.subst('$PROTOC'),
+					'--plugin=protoc-gen-nanopb=' + os.path.join(env.subst('$NANOPB'), 'generator', 'protoc-gen-nanopb'),
+					'--proto_path=' + self.proto_path,
+					'--nanopb_out=' + tmp,
+				] + [str(a) for a in env.subst_list('$PROTOFLAGS')[0]] + todo
+				print "  protoc {} ({} cached)".format(' '.join(todo), len(self.protos) - len(todo))
+				if subprocess.call(cmd):
+					return 1
+				for p in todo:
+					d = os.path.join(self.cache_dir, keys[p])
+					if not os.path.isdir(d):
+						os.makedirs(d)
+					for f in _outputs(p):
+						_copy(os.path.join(tmp, f), os.path.join(d, f))
+			finally:
+				shutil.rmtree(tmp, ignore_errors=True)
+		for p in self.protos:
+			for f in _outputs(p):
+				_copy(os.path.join(self.cache_dir, keys[p], f), os.path.join(self.out_dir, f), changed_only=True)
+
+	def describe(self, target, source, env):
+		return "Generating nanopb code for {}".format(', '.join(self.protos))
+
+	def signature(self):
+		"""
+		What the action does besides $PROTOC, $NANOPB and $PROTOFLAGS, which
+		SCons can't see in a callable's code.
+		"""
+		return json.dumps([self.protos, self.proto_path, self.out_dir])
+
+def messages(header):
+	"""
+	The message types in a generated .pb.h.
+	"""
+	with open(header) as f:
+		return _message.findall(f.read())
+
+def size_probe(target, source, env):
+	"""
+	SCons action: write C to target[0] that records sizeof() and the _size
+	define (-1 if there isn't one) for every message in the .pb.h sources, so
+	the board's compiler works them out.
+	"""
+	lines = ['#include "{}"'.format(os.path.basename(str(h))) for h in source]
+	for h in source:
+		for m in messages(str(h)):
+			lines += [
+				'const long {}{} = sizeof({});'.format(STRUCT_PREFIX, m, m),
+				'#ifdef {}_size'.format(m),
+				'const long {}{} = {}_size;'.format(ENCODED_PREFIX, m, m),
+				'#else',
+				'const long {}{} = -1;'.format(ENCODED_PREFIX, m),
+				'#endif',
+			]
+	with open(str(target[0]), 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+
+def _values(obj):
+	"""
+	{symbol: value} for the longs in an object file.
+	"""
+	e = elf.ELF.load(obj)
+	values = {}
+	for sym in e.symbols():
+		if sym.type != elf.STT_OBJECT or sym.section is None or sym.size not in (2, 4, 8):
+			continue
+		data = e.contents(e.section(sym.section))[sym.value:sym.value+sym.size]
+		values[sym.name] = struct.unpack(e.endian + {2: 'h', 4: 'i', 8: 'q'}[sym.size], bytes(data))[0]
+	return values
+
+def size_report(target, source, env):
+	"""
+	SCons action: print and write (as JSON, to target[0]) the largest encoded
+	size and the struct size of every message, from the compiled size probe in
+	source[0].
+	"""
+	values = _values(str(source[0]))
+	results = {}
+	for name, v in values.items():
+		if name.startswith(STRUCT_PREFIX):
+			m = name[len(STRUCT_PREFIX):]
+			encoded = values.get(ENCODED_PREFIX + m, -1)
+			results[m] = {'struct': v, 'encoded': None if encoded < 0 else encoded}
+	print "Message sizes (largest encoded, struct):"
+	for m in sorted(results):
+		r = results[m]
+		print "  {:30} {:>9} {:>7}".format(m, 'unbounded' if r['encoded'] is None else r['encoded'], r['struct'])
+	with open(str(target[0]), 'w') as f:
+		json.dump(results, f, indent=2, sort_keys=True)
+
+def _ccflags_without_lto(board):
+	"""
+	$CCFLAGS for the size probe: the board's, as they are when it's compiled,
+	less -flto if the board uses LTO.
+	"""
+	def ccflags(target, source, env, for_signature):
+		flags = board.env['CCFLAGS']
+		if board._lto:
+			flags = [f for f in flags if f != '-flto']
+		return flags
+	return ccflags
+
+def describe_size_report(target, source, env):
+	return "Measuring nanopb messages in {}".format(source[0])
+
+def _outputs(proto):
+	base = os.path.splitext(proto)[0]
+	return [base + '.pb.c', base + '.pb.h']
+
+def _copy(src, dest, changed_only=False):
+	"""
+	Copy src to dest atomically; with changed_only, leave dest alone if it's
+	the same already.
+	"""
+	if changed_only and os.path.exists(dest) and _read(src) == _read(dest):
+		return
+	d = os.path.dirname(dest)
+	if d and not os.path.isdir(d):
+		os.makedirs(d)
+	tmp = "{}.{}.tmp".format(dest, os.getpid())
+	shutil.copyfile(src, tmp)
+	os.rename(tmp, dest)
+
+def _read(path):
+	with open(path, 'rb') as f:
+		return f.read()
+
 class NanoPB(object):
 	build_dir = None
 	def __init__(self, env, src_dir=None, build_dir=None):
@@ -51,6 +278,8 @@ class NanoPB(object):
 			}
 		)
 		self.objects = []
+		self.protos = []
+		self._generated = None
 
 	def _findnano(self):
 		usrpath = os.path.expanduser("~/.local/nanopb")
@@ -61,20 +290,80 @@ class NanoPB(object):
 			return syspath
 
 	def add(self, src):
+		"""
+		Add a .proto (relative to src_dir). Everything added is generated
+		together, the first time the NanoPB is iterated.
+		"""
 		src = self.src_dir.File(src)
-		fn = os.path.basename(str(src))
-		b, e = os.path.splitext(fn)
+		# protoc keeps the path under --proto_path
+		rel = os.path.relpath(src.srcnode().get_abspath(), self.src_dir.srcnode().get_abspath())
+		b, e = os.path.splitext(rel)
 		cdest = self.build_dir.File(b+'.pb.c')
 		hdest = self.build_dir.File(b+'.pb.h')
-		p = self.env.Proto([cdest, hdest], src)
-		self.objects += [o for o in p if str(o).endswith('.c')]
+		self.protos.append((rel, src, cdest, hdest))
+		self.objects.append(cdest)
 		self.env.Append(
 			CPPPATH=[hdest.get_dir()]
 		)
 
+	def _cache_dir(self):
+		config = {}
+		try:
+			execfile(os.path.expanduser("~/.arduino-scons"), config)
+		except Exception:
+			pass
+		return cache.cache_dir(config, 'nanopb')
+
+	def _generate(self):
+		if self._generated is not None or not self.protos:
+			return
+		proto_path = self.src_dir.srcnode().get_abspath()
+		deps = set()
+		for _, src, _, _ in self.protos:
+			deps.update(dependencies(src.srcnode().get_abspath(), proto_path))
+		gen = Generate([rel for rel, _, _, _ in self.protos], proto_path, self.build_dir.get_abspath(), self._cache_dir())
+		targets = [t for _, _, c, h in self.protos for t in (c, h)]
+		self._generated = self.env.Command(
+			targets, [self.env.File(d) for d in sorted(deps)] + [self.env.Value(gen.signature())],
+			self.env.Action(gen, strfunction=gen.describe, varlist=['PROTOC', 'NANOPB', 'PROTOFLAGS']),
+		)
+
+	def runtime(self):
+		"""
+		The nanopb runtime, for Arduino.add_runtime().
+		"""
+		srcs = [self.env.File("$NANOPB/"+fn) for fn in ("pb_encode.c", "pb_decode.c", "pb_common.c")]
+		return 'nanopb', srcs, ['$NANOPB']
+
+	def report(self, board, sketch):
+		"""
+		Size report for the messages, compiled for board: <sketch>.nanopb.json
+		in the board's build_dir.
+		"""
+		self._generate()
+		headers = [h for _, _, _, h in self.protos]
+		if not headers:
+			return []
+		probe = board.env.Command(
+			board.variant_dir.File('nanopb-sizes.c'), headers,
+			board.env.Action(size_probe, None),
+		)
+		obj = board.env.Object(
+			board.variant_dir.File('nanopb-sizes.o'), probe,
+			# build_dir for imports, which the generated headers include by path
+			CPPPATH=['$NANOPB'] + sorted(set([self.build_dir] + [h.get_dir() for h in headers]), key=str),
+			# The values have to be in the object, not LTO's intermediate code
+			CCFLAGS=_ccflags_without_lto(board),
+		)
+		return board.env.Command(
+			board.build_dir.File(sketch+'.nanopb.json'), obj,
+			board.env.Action(size_report, strfunction=describe_size_report),
+		)
+
 	def __iter__(self):
-		yield self.env.File("$NANOPB/pb_encode.c")
-		yield self.env.File("$NANOPB/pb_decode.c")
-		yield self.env.File("$NANOPB/pb_common.c")
+		"""
+		The generated sources. The runtime comes from runtime().
+		"""
+		self._generate()
 		for o in self.objects:
 			yield o
@@ -0,0 +1,81 @@
+"""
+A persistent cache of directory listings, so unchanged source trees don't need
+to be walked on every SConstruct evaluation.
+
+A directory's listing is reused as long as its mtime hasn't changed (adding,
+removing or renaming an entry changes it). Set SCONSDUINO_RESCAN=1 in the
+environment to throw the cache away and walk everything again.
+"""
+from __future__ import absolute_import
+import os
+import json
+
+_caches = {}
+
+def get(path):
+	"""
+	The shared ScanCache stored at path.
+	"""
+	if path not in _caches:
+		_caches[path] = ScanCache(path, rescan=bool(os.environ.get('SCONSDUINO_RESCAN')))
+	return _caches[path]
+
+class ScanCache(object):
+	def __init__(self, path, rescan=False):
+		self.path = path
+		self.dirs = {}
+		self.dirty = False
+		if not rescan:
+			try:
+				with open(path) as f:
+					self.dirs = json.load(f)
+			except (IOError, ValueError):
+				pass
+
+	def listdir(self, d):
+		"""
+		Returns (subdirs, files) of d, from the cache if d is unchanged.
+		"""
+		mtime = os.stat(d).st_mtime
+		entry = self.dirs.get(d)
+		if entry is not None and entry[0] == mtime:
+			return list(entry[1]), list(entry[2])
+		dns, fns = [], []
+		for n in sorted(os.listdir(d)):
+			if os.path.isdir(os.path.join(d, n)):
+				dns.append(n)
+			else:
+				fns.append(n)
+		self.dirs[d] = [mtime, dns, fns]
+		self.dirty = True
+		return list(dns), list(fns)
+
+	def walk(self, top):
+		"""
+		Like os.walk(top) (top-down, prune by editing dirnames), but cached.
+		"""
+		top = os.path.abspath(top)
+		stack = [top]
+		while stack:
+			d = stack.pop()
+			try:
+				dns, fns = self.listdir(d)
+			except OSError:
+				continue
+			yield d, dns, fns
+			stack.extend(os.path.join(d, n) for n in reversed(dns))
+		self.save()
+
+	def save(self):
+		if not self.dirty:
+			return
+		tmp = "{}.{}.tmp".format(self.path, os.getpid())
+		try:
+			if not os.path.isdir(os.path.dirname(self.path)):
+				os.makedirs(os.path.dirname(self.path))
+			with open(tmp, 'w') as f:
+				json.dump(self.dirs, f)
+			os.rename(tmp, self.path)
+			self.dirty = False
+		except (IOError, OSError):
+			pass
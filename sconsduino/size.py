@@ -0,0 +1,117 @@
+"""
+Reading sizes out of linked firmware with $SIZE.
+"""
+from __future__ import absolute_import
+import subprocess
+
+def berkeley(size, elf):
+	"""
+	Runs size in Berkeley format, returns {'text': ..., 'data': ..., 'bss': ...}
+	"""
+	out = subprocess.Popen([size, '-B', elf], stdout=subprocess.PIPE).communicate()[0]
+	lines = [l.split() for l in out.splitlines() if l.strip()]
+	head, vals = lines[0], lines[1]
+	return {k: int(v) for k, v in zip(head, vals) if k in ('text', 'data', 'bss')}
+
+def delta(target, source, env):
+	"""
+	SCons action: compare two ELFs (source[0] against source[1]) and write the
+	difference to target.
+	"""
+	new = berkeley(env.subst('$SIZE'), str(source[0]))
+	old = berkeley(env.subst('$SIZE'), str(source[1]))
+	msg = "{}: {} vs {}: {}".format(
+		source[0], env.get('PROFILE_NAME', '?'), env.get('PROFILE_REF', '?'),
+		', '.join(
+			"{} {:+d} ({} vs {})".format(k, new[k] - old[k], new[k], old[k])
+			for k in ('text', 'data', 'bss')
+		)
+	)
+	print msg
+	with open(str(target[0]), 'w') as f:
+		f.write(msg+'\n')
+
+# Bytes, for the whole chip (bootloaders are taken off by the board)
+MCU_LIMITS = {
+	'atmega168': {'flash': 16384, 'ram': 1024, 'eeprom': 512},
+	'atmega328': {'flash': 32768, 'ram': 2048, 'eeprom': 1024},
+	'atmega328p': {'flash': 32768, 'ram': 2048, 'eeprom': 1024},
+	'atmega1280': {'flash': 131072, 'ram': 8192, 'eeprom': 4096},
+	'atmega2560': {'flash': 262144, 'ram': 8192, 'eeprom': 4096},
+	'mk20dx128': {'flash': 131072, 'ram': 16384, 'eeprom': 2048},
+	'mk20dx256': {'flash': 262144, 'ram': 65536, 'eeprom': 2048},
+}
+
+# How sections from `size -A` count. Anything else (debug info, fuses, ...)
+# isn't counted.
+TEXT_SECTIONS = ('.text', '.rodata', '.init', '.fini', '.ARM.exidx', '.ARM.extab')
+DATA_SECTIONS = ('.data',)
+BSS_SECTIONS = ('.bss', '.noinit', '.usbdescriptortable', '.dmabuffers', '.usbbuffers')
+EEPROM_SECTIONS = ('.eeprom',)
+
+def sysv(size, elf):
+	"""
+	Runs size in SysV format, returns {section: size}
+	"""
+	out = subprocess.Popen([size, '-A', elf], stdout=subprocess.PIPE).communicate()[0]
+	sections = {}
+	for l in out.splitlines():
+		parts = l.split()
+		if len(parts) == 3 and parts[0].startswith('.') and parts[1].isdigit():
+			sections[parts[0]] = int(parts[1])
+	return sections
+
+def usage(sections):
+	"""
+	Totals {text, data, bss, eeprom, flash, ram} from sysv() output.
+	"""
+	def total(names):
+		return sum(v for k, v in sections.items() if k in names)
+	u = {
+		'text': total(TEXT_SECTIONS),
+		'data': total(DATA_SECTIONS),
+		'bss': total(BSS_SECTIONS),
+		'eeprom': total(EEPROM_SECTIONS),
+	}
+	# Initializers for .data are stored in flash
+	u['flash'] = u['text'] + u['data']
+	u['ram'] = u['data'] + u['bss']
+	return u
+
+def _pct(used, limit):
+	return "{}/{} ({:.1f}%)".format(used, limit, 100.0 * used / limit) if limit else str(used)
+
+def report(target, source, env):
+	"""
+	SCons action: report the memory use of the ELF in source[0] against the
+	limits in $SIZE_LIMITS, write it as JSON to target[0], and fail if it's over
+	budget.
+
+	$SIZE_LIMITS is a dict of: flash, ram, eeprom (maximum bytes) and free_ram
+	(minimum bytes left for the stack and heap).
+	"""
+	import json
+	limits = env.get('SIZE_LIMITS') or {}
+	u = usage(sysv(env.subst('$SIZE'), str(source[0])))
+	free = limits['ram'] - u['ram'] if limits.get('ram') else None
+	print "{}: flash {}, RAM {} (data {}, bss {}), free RAM {}, EEPROM {}".format(
+		source[0], _pct(u['flash'], limits.get('flash')), _pct(u['ram'], limits.get('ram')),
+		u['data'], u['bss'], '?' if free is None else free, _pct(u['eeprom'], limits.get('eeprom')),
+	)
+
+	errors = []
+	for k in ('flash', 'ram', 'eeprom'):
+		if limits.get(k) is not None and u[k] > limits[k]:
+			errors.append("{} is over budget: {} > {}".format(k, u[k], limits[k]))
+	if free is not None and limits.get('free_ram') is not None and free < limits['free_ram']:
+		errors.append("free RAM is under budget: {} < {}".format(free, limits['free_ram']))
+
+	data = dict(u, elf=str(source[0]), mcu=env.subst('$MCU'), free_ram=free, limits=limits, errors=errors)
+	with open(str(target[0]), 'w') as f:
+		json.dump(data, f, indent=2, sort_keys=True)
+	for e in errors:
+		print "ERROR: {}".format(e)
+	return 1 if errors else 0
+
+def describe(target, source, env):
+	return "Checking memory use of {}".format(source[0])
@@ -0,0 +1,226 @@
+"""
+Worst-case stack depth, from gcc's -fstack-usage (.su) files and a call graph
+read out of the objects with objdump.
+
+Each entry point (main, and every interrupt handler) gets the deepest path
+through the call graph, adding up the frames gcc reported. Anything that
+makes that a guess is reported: recursion, indirect calls, dynamic stack
+allocation and functions without a .su (eg, from libc or libgcc).
+"""
+from __future__ import absolute_import
+import os
+import re
+import json
+import subprocess
+from . import size
+
+# Relocations that are calls (or tail calls)
+CALL_RELOCS = (
+	'R_AVR_CALL', 'R_AVR_13_PCREL',
+	'R_ARM_THM_CALL', 'R_ARM_THM_JUMP24', 'R_ARM_CALL', 'R_ARM_JUMP24', 'R_ARM_PC24',
+)
+INDIRECT_CALLS = ('icall', 'eicall')
+ENTRY_POINTS = ('main',)
+_isr = re.compile(r'^(__vector_\d+|\w+_isr)$')
+
+_section = re.compile(r'^Disassembly of section (\S+):$')
+_function = re.compile(r'^[0-9a-fA-F]+ <(.+)>:$')
+_reloc = re.compile(r'^\s+[0-9a-fA-F]+: (R_\w+)\s+(.+?)(?:[+-]0x[0-9a-fA-F]+)?$')
+_insn = re.compile(r'^\s+[0-9a-fA-F]+:\t(?:[0-9a-fA-F]{2,8} ?)+\s*\t(\S+)\s*(.*)$')
+
+def overhead(mcu):
+	"""
+	(bytes per call, bytes per interrupt) that the frames in .su files don't
+	include: return addresses, and Cortex-M's exception frame.
+	"""
+	if mcu.startswith('mk'):
+		return 0, 32
+	if mcu in ('atmega2560', 'atmega2561'):
+		return 3, 3
+	return 2, 2
+
+def parse_su(path):
+	"""
+	{function: (bytes, qualifiers)} from a .su file.
+	"""
+	funcs = {}
+	with open(path) as f:
+		for line in f:
+			parts = line.rstrip('\n').split('\t')
+			if len(parts) != 3:
+				continue
+			name = parts[0].split(':', 3)[-1]
+			funcs[name] = (int(parts[1]), parts[2])
+	return funcs
+
+def _su_lookup(su, name):
+	"""
+	.su files name C++ functions with their return type ("void loop()"), which
+	objdump -C doesn't, and extern "C" ones with their arguments, which objdump
+	doesn't either.
+	"""
+	if name in su:
+		return su[name]
+	for k, v in su.items():
+		if k.endswith(' '+name):
+			return v
+	for k, v in su.items():
+		if k.split('(')[0].split()[-1] == name:
+			return v
+
+def disassemble(objdump, obj):
+	"""
+	{function: {'calls': set(function), 'indirect': bool}} for an object.
+	"""
+	out = subprocess.Popen([objdump, '-dr', '-C', obj], stdout=subprocess.PIPE).communicate()[0]
+	funcs = {}
+	sections = {}
+	section = func = None
+	for line in out.splitlines():
+		m = _section.match(line)
+		if m:
+			section = m.group(1)
+			continue
+		m = _function.match(line)
+		if m:
+			func = funcs.setdefault(m.group(1), {'calls': set(), 'indirect': False})
+			sections.setdefault(section, m.group(1))
+			continue
+		if func is None:
+			continue
+		m = _reloc.match(line)
+		if m:
+			if m.group(1) in CALL_RELOCS:
+				func['calls'].add(m.group(2))
+			continue
+		m = _insn.match(line)
+		if m:
+			op, args = m.group(1), m.group(2).strip()
+			if op in INDIRECT_CALLS or (op == 'blx' and re.match(r'^r\d+$', args)):
+				func['indirect'] = True
+	# Calls to static functions in their own section (-ffunction-sections) are
+	# made through the section; anything else through a section is a local jump
+	for f in funcs.values():
+		calls = set()
+		for c in f['calls']:
+			if c.startswith('.text.') and c in sections:
+				calls.add(sections[c])
+			elif not c.startswith('.'):
+				calls.add(c)
+		f['calls'] = calls
+	return funcs
+
+class CallGraph(object):
+	def __init__(self):
+		# (object, function) -> {'frame', 'qualifiers', 'calls', 'indirect'}
+		self.nodes = {}
+		# function -> [(object, function)]
+		self.by_name = {}
+
+	def add(self, obj, funcs, su):
+		for name, f in funcs.items():
+			info = _su_lookup(su, name)
+			self.nodes[(obj, name)] = {
+				'frame': info[0] if info else None,
+				'qualifiers': info[1] if info else '',
+				'calls': f['calls'],
+				'indirect': f['indirect'],
+			}
+			self.by_name.setdefault(name, []).append((obj, name))
+
+	def resolve(self, obj, name):
+		if (obj, name) in self.nodes:
+			return (obj, name)
+		for key in self.by_name.get(name, []):
+			return key
+
+	def entry_points(self):
+		return sorted(
+			key for key in self.nodes
+			if key[1] in ENTRY_POINTS or _isr.match(key[1])
+		)
+
+	def depth(self, key, call, notes):
+		"""
+		(bytes, path) of the deepest stack from key. Problems are added to notes.
+		"""
+		memo = {}
+		def walk(key, stack):
+			if key in memo:
+				return memo[key]
+			node = self.nodes[key]
+			frame = node['frame']
+			if frame is None:
+				notes.add("no stack usage for {}".format(key[1]))
+				frame = 0
+			if 'dynamic' in node['qualifiers'] and 'bounded' not in node['qualifiers']:
+				notes.add("unbounded dynamic stack in {}".format(key[1]))
+			if node['indirect']:
+				notes.add("indirect calls in {}".format(key[1]))
+			best, path = 0, []
+			for c in sorted(node['calls']):
+				ck = self.resolve(key[0], c)
+				if ck is None:
+					notes.add("no stack usage for {}".format(c))
+					continue
+				if ck in stack:
+					notes.add("recursion through {}".format(c))
+					continue
+				d, p = walk(ck, stack | set([ck]))
+				if d + call > best:
+					best, path = d + call, p
+			memo[key] = frame + best, [key[1]] + path
+			return memo[key]
+		return walk(key, set([key]))
+
+def report(target, source, env):
+	"""
+	SCons action: worst-case stack depth for the ELF in source[0], built from
+	the objects in source[1:]. Writes JSON to target[0], and fails if static RAM
+	plus the deepest main and interrupt stacks is more than $SIZE_LIMITS['ram'].
+	"""
+	objdump = env.subst('$OBJDUMP')
+	mcu = env.subst('$MCU')
+	call, interrupt = overhead(mcu)
+	graph = CallGraph()
+	for obj in source[1:]:
+		obj = str(obj)
+		su = os.path.splitext(obj)[0] + '.su'
+		graph.add(obj, disassemble(objdump, obj), parse_su(su) if os.path.exists(su) else {})
+
+	notes = set()
+	entries = {}
+	for key in graph.entry_points():
+		d, path = graph.depth(key, call, notes)
+		if key[1] not in ENTRY_POINTS:
+			d += interrupt
+		entries[key[1]] = {'bytes': d, 'path': path}
+
+	main = max([e['bytes'] for n, e in entries.items() if n in ENTRY_POINTS] or [0])
+	isr = max([e['bytes'] for n, e in entries.items() if n not in ENTRY_POINTS] or [0])
+	u = size.usage(size.sysv(env.subst('$SIZE'), str(source[0])))
+	ram = (env.get('SIZE_LIMITS') or {}).get('ram')
+	total = u['ram'] + main + isr
+
+	for n in sorted(entries, key=lambda n: -entries[n]['bytes']):
+		print "  stack {:5d} {} ({})".format(entries[n]['bytes'], n, ' -> '.join(entries[n]['path']))
+	print "{}: static RAM {} + main stack {} + interrupt stack {} = {}{}".format(
+		source[0], u['ram'], main, isr, total, '/{}'.format(ram) if ram else '',
+	)
+	for n in sorted(notes):
+		print "WARNING: stack depth is a guess: {}".format(n)
+
+	errors = []
+	if ram and total > ram:
+		errors.append("worst-case RAM use is over what the MCU has: {} > {}".format(total, ram))
+	with open(str(target[0]), 'w') as f:
+		json.dump({
+			'elf': str(source[0]), 'mcu': mcu, 'static_ram': u['ram'], 'main': main, 'interrupt': isr,
+			'total': total, 'ram': ram, 'entry_points': entries, 'notes': sorted(notes), 'errors': errors,
+		}, f, indent=2, sort_keys=True)
+	for e in errors:
+		print "ERROR: {}".format(e)
+	return 1 if errors else 0
+
+def describe(target, source, env):
+	return "Checking stack usage of {}".format(source[0])
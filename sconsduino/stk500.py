@@ -0,0 +1,586 @@
+"""
+Uploading over STK500v1, what Arduino bootloaders (avrdude's -carduino) and
+ArduinoISP (-cstk500v1) speak, without avrdude.
+
+The port is tried at each baud rate in turn, fastest first. Each page's load
+address and data go out in one write, so a page costs one round trip instead
+of two, and everything written is read back and compared. Pages aren't sent
+ahead of the replies: bootloaders stop reading the UART while they write a
+page, so anything sent meanwhile is lost.
+
+Given a state file, only pages that changed since the last upload to that
+device are written. A few of the unchanged pages are read back first; if
+they don't match (another image was flashed some other way, a different
+board on the port, ...) everything is written after all.
+
+Fuses are read first and only the ones that differ are written. They're
+always read: the port is the programmer's, so what was last set through it
+says nothing about the chip on the other end.
+
+Simulator runs a bootloader on a pty, to try all this without hardware:
+	python -m sconsduino.stk500 simulate atmega328p
+	python -m sconsduino.stk500 upload /dev/pts/N atmega328p blinky.hex
+
+Serial ports are driven with termios, so this is POSIX only.
+"""
+from __future__ import absolute_import
+import os
+import sys
+import json
+import pty
+import time
+import fcntl
+import errno
+import select
+import struct
+import termios
+import threading
+from . import elf
+
+STK_OK = 0x10
+STK_INSYNC = 0x14
+STK_NOSYNC = 0x15
+CRC_EOP = 0x20
+STK_GET_SYNC = 0x30
+STK_GET_PARAMETER = 0x41
+STK_SET_DEVICE = 0x42
+STK_SET_DEVICE_EXT = 0x45
+STK_ENTER_PROGMODE = 0x50
+STK_LEAVE_PROGMODE = 0x51
+STK_LOAD_ADDRESS = 0x55
+STK_UNIVERSAL = 0x56
+STK_PROG_PAGE = 0x64
+STK_READ_PAGE = 0x74
+STK_READ_SIGN = 0x75
+
+# MCU: (signature, page size, flash size, EEPROM size)
+PARTS = {
+	'atmega168': (b'\x1e\x94\x06', 128, 16384, 512),
+	'atmega328': (b'\x1e\x95\x14', 128, 32768, 1024),
+	'atmega328p': (b'\x1e\x95\x0f', 128, 32768, 1024),
+	'atmega1280': (b'\x1e\x97\x03', 256, 131072, 4096),
+	'atmega2560': (b'\x1e\x98\x01', 256, 262144, 4096),
+}
+
+# Universal (ISP) commands for fuses: (read, write)
+FUSES = {
+	'lfuse': ((0x50, 0x00), (0xAC, 0xA0)),
+	'hfuse': ((0x58, 0x08), (0xAC, 0xA8)),
+	'efuse': ((0x50, 0x08), (0xAC, 0xA4)),
+}
+# The fuse bits the parts above use; unused ones read back as 1
+FUSE_MASKS = {
+	'lfuse': 0xFF,
+	'hfuse': 0xFF,
+	'efuse': 0x07,
+}
+
+# Unchanged pages read back to check the device still has the last upload
+SAMPLE_PAGES = 4
+SYNC_TRIES = 5
+# Without a reset, long enough for an Uno hosting ArduinoISP to get past its
+# own bootloader, if opening the port reset it
+ISP_SYNC_TRIES = 30
+SYNC_TIMEOUT = 0.1
+TIMEOUT = 1.0
+
+class UploadError(Exception):
+	pass
+
+
+class Port(object):
+	"""
+	A serial port in raw mode.
+	"""
+	def __init__(self, path, baud):
+		self.path = path
+		self.baud = baud
+		self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+		try:
+			attrs = termios.tcgetattr(self.fd)
+			attrs[0] = attrs[1] = attrs[3] = 0
+			attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+			attrs[4] = attrs[5] = getattr(termios, 'B{}'.format(baud))
+			attrs[6][termios.VMIN] = 0
+			attrs[6][termios.VTIME] = 0
+			termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+		except Exception:
+			os.close(self.fd)
+			raise
+
+	def close(self):
+		os.close(self.fd)
+
+	def reset(self):
+		"""
+		Drop DTR and RTS, which resets an Arduino into its bootloader.
+		"""
+		bits = struct.pack('I', termios.TIOCM_DTR | termios.TIOCM_RTS)
+		try:
+			fcntl.ioctl(self.fd, termios.TIOCMBIC, bits)
+			time.sleep(0.25)
+			fcntl.ioctl(self.fd, termios.TIOCMBIS, bits)
+			time.sleep(0.05)
+		except (IOError, OSError):
+			# Not a real serial port (eg, a pty)
+			pass
+		self.flush()
+
+	def flush(self):
+		termios.tcflush(self.fd, termios.TCIFLUSH)
+
+	def write(self, data):
+		data = bytes(bytearray(data))
+		while data:
+			select.select([], [self.fd], [], TIMEOUT)
+			try:
+				n = os.write(self.fd, data)
+			except OSError as e:
+				if e.errno == errno.EAGAIN:
+					continue
+				raise
+			data = data[n:]
+
+	def read(self, n, timeout=TIMEOUT):
+		buf = bytearray()
+		deadline = time.time() + timeout
+		while len(buf) < n:
+			left = deadline - time.time()
+			if left <= 0 or not select.select([self.fd], [], [], left)[0]:
+				break
+			try:
+				buf.extend(os.read(self.fd, n - len(buf)))
+			except OSError as e:
+				if e.errno != errno.EAGAIN:
+					raise
+		return buf
+
+
+class Programmer(object):
+	"""
+	An STK500v1 session with a bootloader (or ArduinoISP).
+	"""
+	def __init__(self, port, mcu):
+		if mcu not in PARTS:
+			raise UploadError("Don't know how to program {}".format(mcu))
+		self.port = port
+		self.mcu = mcu
+		self.signature, self.page_size, self.flash_size, self.eeprom_size = PARTS[mcu]
+		self._ext = None
+
+	@classmethod
+	def connect(cls, path, mcu, bauds, reset=True):
+		"""
+		Reset the board and get in sync, at the first of bauds that works.
+
+		reset - Toggle DTR to get into the bootloader. Not for ISP programmers,
+		where it would reset the board the programmer runs on.
+		"""
+		for baud in bauds:
+			port = Port(path, baud)
+			if reset:
+				port.reset()
+			else:
+				port.flush()
+			p = cls(port, mcu)
+			if p.sync(SYNC_TRIES if reset else ISP_SYNC_TRIES):
+				return p
+			port.close()
+		raise UploadError("No response from {} at {} baud".format(path, ', '.join(str(b) for b in bauds)))
+
+	def close(self):
+		self.port.close()
+
+	def sync(self, tries=SYNC_TRIES):
+		for i in range(tries):
+			self.port.write([STK_GET_SYNC, CRC_EOP])
+			if self.port.read(2, SYNC_TIMEOUT) == bytearray([STK_INSYNC, STK_OK]):
+				self.port.flush()
+				return True
+		return False
+
+	def _check(self, n, what):
+		"""
+		Read a reply with n bytes of data.
+		"""
+		resp = self.port.read(n + 2)
+		if len(resp) != n + 2 or resp[0] != STK_INSYNC or resp[-1] != STK_OK:
+			raise UploadError("Bad reply to {}: {!r}".format(what, bytes(resp)))
+		return resp[1:-1]
+
+	def command(self, cmd, n=0):
+		self.port.write(bytearray(cmd) + bytearray([CRC_EOP]))
+		return self._check(n, "command 0x{:02x}".format(cmd[0]))
+
+	def universal(self, a, b, c, d):
+		return self.command([STK_UNIVERSAL, a, b, c, d], 1)[0]
+
+	def read_signature(self):
+		return bytes(self.command([STK_READ_SIGN], 3))
+
+	def set_device(self):
+		# Only ArduinoISP cares about this (for the page size and chip size)
+		params = bytearray(20)
+		params[4:6] = b'\x01\x01'
+		params[8:12] = b'\xff\xff\xff\xff'
+		params[12:14] = struct.pack('>H', self.page_size)
+		params[14:16] = struct.pack('>H', self.eeprom_size)
+		params[16:20] = struct.pack('>I', self.flash_size)
+		self.command(bytearray([STK_SET_DEVICE]) + params)
+
+	def enter(self):
+		self.set_device()
+		self.command([STK_ENTER_PROGMODE])
+
+	def leave(self):
+		self.command([STK_LEAVE_PROGMODE])
+
+	def erase(self):
+		"""
+		Chip erase, for ISP. Bootloaders erase each page as they write it.
+		"""
+		self.universal(0xAC, 0x80, 0x00, 0x00)
+		time.sleep(0.01)
+
+	def read_fuse(self, name):
+		(a, b), _ = FUSES[name]
+		return self.universal(a, b, 0x00, 0x00)
+
+	def write_fuse(self, name, value):
+		_, (a, b) = FUSES[name]
+		self.universal(a, b, 0x00, value)
+
+	def _load_address(self, addr):
+		"""
+		Commands to point at a byte address: word address, plus the extended
+		address for parts with more than 128K.
+		"""
+		cmd = bytearray()
+		n = 0
+		words = addr >> 1
+		if self.flash_size > 0x20000 and (words >> 16) != self._ext:
+			self._ext = words >> 16
+			cmd += bytearray([STK_UNIVERSAL, 0x4D, 0x00, self._ext, 0x00, CRC_EOP])
+			n += 1
+		cmd += bytearray([STK_LOAD_ADDRESS, words & 0xFF, (words >> 8) & 0xFF, CRC_EOP])
+		return cmd, n
+
+	def _load_replies(self, n):
+		for i in range(n):
+			self._check(1, "extended address")
+		self._check(0, "load address")
+
+	def write_pages(self, pages):
+		"""
+		Write {address: bytearray} to flash, one round trip a page.
+		"""
+		for addr in sorted(pages):
+			data = pages[addr]
+			cmd, n = self._load_address(addr)
+			cmd += bytearray([STK_PROG_PAGE, len(data) >> 8, len(data) & 0xFF, ord('F')]) + data + bytearray([CRC_EOP])
+			self.port.write(cmd)
+			self._load_replies(n)
+			self._check(0, "page write at 0x{:x}".format(addr))
+
+	def read_page(self, addr, size):
+		cmd, n = self._load_address(addr)
+		cmd += bytearray([STK_READ_PAGE, size >> 8, size & 0xFF, ord('F'), CRC_EOP])
+		self.port.write(cmd)
+		self._load_replies(n)
+		return self._check(size, "page read at 0x{:x}".format(addr))
+
+	def verify_pages(self, pages):
+		"""
+		Read back {address: bytearray}; raises UploadError on a mismatch.
+		"""
+		for addr in sorted(pages):
+			got = self.read_page(addr, len(pages[addr]))
+			if got != pages[addr]:
+				bad = next(i for i in range(len(got)) if got[i] != pages[addr][i])
+				raise UploadError("Verify failed at 0x{:x}: 0x{:02x} != 0x{:02x}".format(
+					addr + bad, got[bad], pages[addr][bad]))
+
+
+def pages(chunks, page_size, fill=0xFF):
+	"""
+	{page address: bytearray} covering [(address, bytearray)].
+	"""
+	out = {}
+	for addr, data in chunks:
+		for i, b in enumerate(data):
+			a = addr + i
+			page = a - a % page_size
+			if page not in out:
+				out[page] = bytearray([fill] * page_size)
+			out[page][a - page] = b
+	return out
+
+def load_state(path, mcu):
+	"""
+	{page address: bytearray} last flashed, or None if there's no record of it
+	(or it was for another MCU).
+	"""
+	try:
+		with open(path) as f:
+			state = json.load(f)
+	except (IOError, ValueError):
+		return None
+	if state.get('mcu') != mcu:
+		return None
+	return {int(a): bytearray.fromhex(d) for a, d in state['pages'].items()}
+
+def save_state(path, mcu, flashed):
+	d = os.path.dirname(path)
+	if d and not os.path.isdir(d):
+		os.makedirs(d)
+	tmp = "{}.{}.tmp".format(path, os.getpid())
+	with open(tmp, 'w') as f:
+		json.dump({'mcu': mcu, 'pages': {str(a): ''.join('{:02x}'.format(b) for b in data) for a, data in flashed.items()}}, f)
+	os.rename(tmp, path)
+
+def forget_state(path):
+	if path and os.path.exists(path):
+		os.unlink(path)
+
+def program_fuses(p, fuses, log=None):
+	"""
+	Write (low, high, extended) fuses, skipping the ones that are already set.
+	Only the bits in FUSE_MASKS are compared. Returns how many were written.
+	"""
+	wanted = dict(zip(('lfuse', 'hfuse', 'efuse'), fuses))
+	written = 0
+	for name in ('lfuse', 'hfuse', 'efuse'):
+		mask = FUSE_MASKS[name]
+		value = p.read_fuse(name)
+		if value & mask != wanted[name] & mask:
+			if log is not None:
+				log("Changing {} from 0x{:02X} to 0x{:02X}".format(name, value, wanted[name]))
+			p.write_fuse(name, wanted[name])
+			if p.read_fuse(name) & mask != wanted[name] & mask:
+				raise UploadError("{} didn't change to 0x{:02X}".format(name, wanted[name]))
+			written += 1
+	return written
+
+def _sample(addrs, n):
+	addrs = sorted(addrs)
+	if len(addrs) <= n:
+		return addrs
+	return [addrs[i * (len(addrs) - 1) // (n - 1)] for i in range(n)]
+
+def upload(path, mcu, hexfile, bauds, erase=False, fuses=None, verify=True, state=None, reset=True, log=None):
+	"""
+	Flash hexfile to the board on path. Returns a dict of what happened.
+
+	erase - Chip erase first (for ISP programmers)
+	fuses - (low, high, extended) to write first (ISP programmers)
+	state - File recording what was last flashed, to only write changed pages.
+	Not used with erase.
+	reset - Reset the board into its bootloader first (not for ISP programmers)
+	"""
+	start = time.time()
+	with open(hexfile) as f:
+		chunks = elf.read_ihex(f.read())
+	if mcu not in PARTS:
+		raise UploadError("Don't know how to program {}".format(mcu))
+	for addr, data in chunks:
+		if addr + len(data) > PARTS[mcu][2]:
+			raise UploadError("{} doesn't fit in a {}".format(hexfile, mcu))
+	p = Programmer.connect(path, mcu, bauds, reset)
+	try:
+		sig = p.read_signature()
+		if sig != p.signature:
+			raise UploadError("Expected a {} (signature {}), found {}".format(
+				mcu, p.signature.encode('hex'), sig.encode('hex')))
+		p.enter()
+		written = 0
+		if fuses is not None:
+			written = program_fuses(p, fuses, log)
+		if erase:
+			p.erase()
+		image = pages(chunks, p.page_size)
+		todo = image
+		last = None if erase or state is None or os.environ.get('SCONSDUINO_FULL_UPLOAD') else load_state(state, mcu)
+		if last is not None:
+			same = [a for a in image if last.get(a) == image[a]]
+			try:
+				p.verify_pages({a: image[a] for a in _sample(same, SAMPLE_PAGES)})
+			except UploadError:
+				if log is not None:
+					log("{} doesn't have what was last uploaded, writing everything".format(path))
+			else:
+				todo = {a: d for a, d in image.items() if last.get(a) != d}
+		# Until it's verified, what's on the device isn't known
+		forget_state(state)
+		p.write_pages(todo)
+		if verify:
+			p.verify_pages(todo)
+		p.leave()
+		if state is not None and not erase:
+			save_state(state, mcu, image)
+	finally:
+		p.close()
+	result = {
+		'port': path, 'baud': p.port.baud, 'pages': len(todo), 'total_pages': len(image), 'fuses': written,
+		'bytes': sum(len(d) for _, d in chunks), 'seconds': time.time() - start,
+	}
+	if log is not None:
+		log("Wrote {pages} of {total_pages} pages ({bytes} bytes) to {port} at {baud} baud in {seconds:.1f}s".format(**result)
+			+ (", verified" if verify else ""))
+	return result
+
+
+class Upload(object):
+	"""
+	SCons action to upload source[0].
+
+	port - Substituted when the upload runs, so it can be $SERIAL_PORT
+	state - The state file (see upload()), or a function of the port giving it
+	"""
+	def __init__(self, port, bauds, erase=False, fuses=None, state=None, reset=True):
+		self.port = port
+		self.reset = reset
+		self.bauds = bauds
+		self.erase = erase
+		self.fuses = fuses
+		self.state = state
+
+	def __call__(self, target, source, env):
+		port = env.subst(self.port)
+		state = self.state(port) if callable(self.state) else self.state
+		try:
+			upload(
+				port, env.subst('$MCU'), str(source[0]), self.bauds,
+				erase=self.erase, fuses=self.fuses, state=state,
+				reset=self.reset, log=_print,
+			)
+		except (UploadError, OSError, IOError) as e:
+			print "ERROR: {}".format(e)
+			return 1
+
+	def describe(self, target, source, env):
+		return "Uploading {} to {}".format(source[0], env.subst(self.port))
+
+def _print(msg):
+	print msg
+
+
+class Simulator(object):
+	"""
+	A bootloader on the other end of a pty. It only answers at the given baud
+	rates, and pretends to be an ISP programmer for fuses and chip erase.
+	Unused fuse bits read as 1, as on real chips.
+	"""
+	def __init__(self, mcu='atmega328p', bauds=(115200,), fuses=(0xFF, 0xDA, 0x05)):
+		self.signature, self.page_size, size, _ = PARTS[mcu]
+		self.flash = bytearray([0xFF] * size)
+		self.bauds = [getattr(termios, 'B{}'.format(b)) for b in bauds]
+		self.fuses = dict(zip(('lfuse', 'hfuse', 'efuse'), fuses))
+		self.pages_written = 0
+		self.fuse_writes = 0
+		self._addr = self._ext = 0
+		self._stop = False
+		self.master, self.slave = pty.openpty()
+		self.port = os.ttyname(self.slave)
+		self._thread = threading.Thread(target=self._serve)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def close(self):
+		self._stop = True
+		self._thread.join()
+		os.close(self.master)
+		os.close(self.slave)
+
+	def _getch(self):
+		while not self._stop:
+			if select.select([self.master], [], [], 0.05)[0]:
+				return ord(os.read(self.master, 1))
+		raise EOFError
+
+	def _getn(self, n):
+		return bytearray(self._getch() for i in range(n))
+
+	def _reply(self, data=b''):
+		if self._getch() == CRC_EOP:
+			os.write(self.master, bytes(bytearray([STK_INSYNC]) + bytearray(data) + bytearray([STK_OK])))
+		else:
+			os.write(self.master, bytes(bytearray([STK_NOSYNC])))
+
+	def _universal(self, a, b, c, d):
+		for name, (read, write) in FUSES.items():
+			if (a, b) == read:
+				return self.fuses[name] | (~FUSE_MASKS[name] & 0xFF)
+			if (a, b) == write:
+				self.fuses[name] = d
+				self.fuse_writes += 1
+				return d
+		if (a, b) == (0x4D, 0x00):
+			self._ext = c << 17
+		elif (a, b) == (0xAC, 0x80):
+			self.flash[:] = bytearray([0xFF] * len(self.flash))
+		return 0
+
+	def _serve(self):
+		try:
+			while True:
+				cmd = self._getch()
+				if termios.tcgetattr(self.slave)[4] not in self.bauds:
+					# Garbage, at the wrong baud rate
+					continue
+				if cmd == STK_GET_PARAMETER:
+					self._reply([{0x81: 4, 0x82: 4, 0x83: 4}.get(self._getch(), 3)])
+				elif cmd == STK_SET_DEVICE:
+					self._getn(20)
+					self._reply()
+				elif cmd == STK_SET_DEVICE_EXT:
+					self._getn(5)
+					self._reply()
+				elif cmd == STK_LOAD_ADDRESS:
+					lo, hi = self._getn(2)
+					self._addr = self._ext + (((hi << 8) | lo) << 1)
+					self._reply()
+				elif cmd == STK_UNIVERSAL:
+					self._reply([self._universal(*self._getn(4))])
+				elif cmd == STK_PROG_PAGE:
+					hi, lo, _ = self._getn(3)
+					data = self._getn((hi << 8) | lo)
+					self.flash[self._addr:self._addr+len(data)] = data
+					self.pages_written += 1
+					self._reply()
+				elif cmd == STK_READ_PAGE:
+					hi, lo, _ = self._getn(3)
+					self._reply(self.flash[self._addr:self._addr+((hi << 8) | lo)])
+				elif cmd == STK_READ_SIGN:
+					self._reply(self.signature)
+				else:
+					# Sync, entering and leaving programming mode, ...
+					self._reply()
+		except (EOFError, OSError):
+			pass
+
+
+def main(argv):
+	"""
+	upload PORT MCU HEX [BAUD,...] - Flash HEX
+	simulate MCU [BAUD,...] - Run a simulated bootloader on a pty
+	"""
+	if argv[:1] == ['upload'] and len(argv) in (4, 5):
+		bauds = [int(b) for b in (argv[4] if len(argv) > 4 else '115200,57600,19200').split(',')]
+		try:
+			upload(argv[1], argv[2], argv[3], bauds, log=_print)
+		except UploadError as e:
+			sys.exit(str(e))
+	elif argv[:1] == ['simulate'] and len(argv) in (2, 3):
+		bauds = [int(b) for b in (argv[2] if len(argv) > 2 else '115200').split(',')]
+		sim = Simulator(argv[1], bauds)
+		print "Simulated {} bootloader on {}".format(argv[1], sim.port)
+		try:
+			while True:
+				time.sleep(1)
+		except KeyboardInterrupt:
+			sim.close()
+	else:
+		sys.exit(main.__doc__)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -1,11 +1,14 @@
 from __future__ import absolute_import
 import time
-from . import Arduino
+from . import Arduino, devices
 
 class Teensy3(Arduino):
 	"""
 	A Teensy3 or 3.1 board.
 	"""
+	PCH_HEADERS = ['Arduino.h', 'WProgram.h']
+	IMAGES = ['.hex', '.eep', '.bin']
+	USB_IDS = devices.TEENSY
 
 	def __init__(self, *p, **kw):
 		super(Teensy3, self).__init__(*p, **kw)
@@ -26,11 +29,10 @@ class Teensy3(Arduino):
 			LINKFLAGS=['-mcpu=cortex-m4', '-mthumb', '-T$LDSCRIPT'],
 			LIBS=['arm_cortexM4l_math', 'm'],
 			LOAD='teensy_loader_cli', # TODO: run find algorithm
-			LOADFLAGS=['-w', '-v'],
-		)
-		self.env.Replace(
-			**self._find_tools(self.env.Dir("$ARDUINO").Dir('hardware').Dir('tools').Dir('arm-none-eabi').Dir('bin'), prefix='arm-none-eabi-')
+			# Soft reboot into the bootloader, rather than waiting for the button
+			LOADFLAGS=['-w', '-s', '-v'],
 		)
+		self._use_tools(self.env.Dir("$ARDUINO").Dir('hardware').Dir('tools').Dir('arm-none-eabi').Dir('bin'), prefix='arm-none-eabi-')
 		if self.version == 3.0:
 			self.env.Append(
 				CPPDEFINES={'__MK20DX128__': ''},
@@ -63,6 +65,19 @@ class Teensy3(Arduino):
 			CPPDEFINES={'LAYOUT_'+layout: ''}
 		)
 
+	def verify_upload(self, target, source, env):
+		"""
+		teensy_loader_cli can't choose between several Teensies, so check
+		first. With none found, it waits (-w) for one: a crashed board, or one
+		without USB, can still be flashed by pressing its button.
+		"""
+		found = self.find_boards(ports=False)
+		if not found:
+			print "WARNING: No Teensy attached; press the button on the board to upload"
+			return None
+		if len(found) > 1:
+			return "Several Teensies attached, and teensy_loader_cli can't choose between them:\n" + '\n'.join("  {}".format(d) for d in found)
+
 	def upload_command(self):
 		return "$LOAD -mmcu=$MCU $LOADFLAGS $SOURCE"
 
@@ -0,0 +1,75 @@
+"""
+Unity (amalgamated) builds: compiling several sources as one translation unit.
+"""
+from __future__ import absolute_import
+import os
+import re
+
+# File-scope statics and #defines are what usually break amalgamation
+STATIC = re.compile(r'^static\s+[^;={(]*?\b(\w+)\s*(?:\[[^\]]*\]\s*)*[;=(]', re.M)
+DEFINE = re.compile(r'^\s*#\s*define\s+(\w+)', re.M)
+INCLUDE = re.compile(r'^\s*#\s*include\b', re.M)
+
+def file_scope_names(fn):
+	"""
+	Names a file defines that would leak into, or clash with, its neighbours.
+	"""
+	with open(fn) as f:
+		text = f.read()
+	return set(STATIC.findall(text)) | set(DEFINE.findall(text))
+
+def configures_headers(fn):
+	"""
+	Whether a file #defines something before its first #include (like the AVR
+	core's wiring_digital.c defining ARDUINO_MAIN for pins_arduino.h). Once an
+	earlier file in the chunk has included the header, its include guard hides
+	whatever the define was meant to switch on.
+	"""
+	with open(fn) as f:
+		text = f.read()
+	m = INCLUDE.search(text)
+	return m is not None and DEFINE.search(text, 0, m.start()) is not None
+
+def group(files, chunk, unsafe=()):
+	"""
+	Splits files into chunks of at most chunk files of the same language.
+	Returns (chunks, singles): singles are the files to compile on their own,
+	either because they're listed in unsafe (by basename), because they
+	#define something for the headers they include, or because they share a
+	file-scope name with something already in their chunk.
+	"""
+	chunks, singles = [], []
+	for ext in ('.c', '.cpp'):
+		cur, names = [], set()
+		for fn in files:
+			if os.path.splitext(fn)[1] != ext:
+				continue
+			if os.path.basename(fn) in unsafe or configures_headers(fn):
+				singles.append(fn)
+				continue
+			n = file_scope_names(fn)
+			if n & names:
+				singles.append(fn)
+				continue
+			cur.append(fn)
+			names |= n
+			if len(cur) >= chunk:
+				chunks.append(cur)
+				cur, names = [], set()
+		if len(cur) > 1:
+			chunks.append(cur)
+		else:
+			singles += cur
+	return chunks, singles
+
+def write(target, source, env):
+	"""
+	SCons action: write a unity file including the paths in source[0] (a Value).
+	"""
+	with open(str(target[0]), 'w') as f:
+		f.write("/* Generated by sconsduino, do not edit */\n")
+		for fn in source[0].read().splitlines():
+			f.write('#include "{}"\n'.format(fn))
+
+def describe(target, source, env):
+	return "Amalgamating {} ({} files)".format(target[0], len(source[0].read().splitlines()))
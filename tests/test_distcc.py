@@ -0,0 +1,104 @@
+"""
+Client/worker round trips over localhost, with the host's gcc.
+
+	python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+from distutils.spawn import find_executable
+from sconsduino import distcc
+
+GCC = find_executable('gcc')
+
+@unittest.skipIf(GCC is None, "needs gcc")
+class RoundTrip(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.src = os.path.join(self.dir, 'hello.c')
+		with open(self.src, 'w') as f:
+			f.write('#define N 3\nint hello(void) { return N; }\n')
+		self.out = os.path.join(self.dir, 'hello.o')
+		self.worker = None
+
+	def tearDown(self):
+		if self.worker is not None:
+			self.worker.shutdown()
+			self.worker.server_close()
+		shutil.rmtree(self.dir)
+
+	def serve(self, **kw):
+		self.worker = distcc.Worker(('127.0.0.1', 0), [GCC], **kw)
+		t = threading.Thread(target=self.worker.serve_forever)
+		t.daemon = True
+		t.start()
+		return ['127.0.0.1:{}'.format(self.worker.server_address[1])]
+
+	def remote(self, hosts, *flags, **kw):
+		job = distcc.CompileJob([GCC, '-c'] + list(flags) + [self.src, '-o', self.out])
+		# Sent to the worker, but not given to the local preprocessor
+		job.cc_args += kw.get('unsafe', [])
+		return distcc.run_remote(job, hosts)
+
+	def test_compiles_remotely(self):
+		hosts = self.serve()
+		self.assertEqual(self.remote(hosts, '-O2', '-Wall', '-g'), 0)
+		with open(self.out, 'rb') as f:
+			self.assertEqual(f.read(4), b'\x7fELF')
+
+	def test_compile_errors_come_back(self):
+		hosts = self.serve()
+		with open(self.src, 'a') as f:
+			f.write('int broken(void) { return }\n')
+		self.assertNotEqual(self.remote(hosts), 0)
+		self.assertFalse(os.path.exists(self.out))
+
+	def test_warnings_with_stderr_piped(self):
+		# gcc quotes with U+2018/U+2019 in a UTF-8 locale
+		env = dict(os.environ, LC_ALL='C.UTF-8')
+		old = os.environ.copy()
+		os.environ.update(env)
+		try:
+			hosts = self.serve()
+			with open(self.src, 'a') as f:
+				f.write('int unused(void) { int x; return 0; }\n')
+			p = subprocess.Popen(
+				[sys.executable, '-m', 'sconsduino.distcc', 'compile', hosts[0], '--',
+					GCC, '-c', '-Wall', self.src, '-o', self.out],
+				stderr=subprocess.PIPE, env=env,
+				cwd=os.path.dirname(os.path.dirname(os.path.abspath(distcc.__file__))),
+			)
+			err = p.communicate()[1]
+		finally:
+			os.environ.clear()
+			os.environ.update(old)
+		self.assertEqual(p.returncode, 0, err)
+		self.assertIn('unused variable', err)
+		self.assertTrue(os.path.exists(self.out))
+
+	def test_refuses_unsafe_flags(self):
+		hosts = self.serve()
+		for flag in ('-wrapper=/bin/sh', '-fplugin=/tmp/x.so', '-specs=/tmp/x', '@/tmp/args', '-Wl,-T,x', '-B/tmp'):
+			self.assertIsNone(self.remote(hosts, unsafe=[flag]), flag)
+		self.assertFalse(os.path.exists(self.out))
+
+	def test_refuses_other_hosts(self):
+		hosts = self.serve(allow=['192.0.2.1'])
+		self.assertIsNone(self.remote(hosts))
+
+	def test_falls_back_locally(self):
+		self.assertEqual(distcc.client([GCC, '-c', self.src, '-o', self.out], ['127.0.0.1:1']), 0)
+		self.assertTrue(os.path.exists(self.out))
+
+class SafeArgs(unittest.TestCase):
+	def test_flags(self):
+		self.assertTrue(distcc.safe_args(['-c', '-Os', '-mmcu=atmega328p', '-ffunction-sections', '-std=gnu11', '-w']))
+		self.assertFalse(distcc.safe_args(['-wrapper', 'gdb']))
+		self.assertFalse(distcc.safe_args([1]))
+
+if __name__ == '__main__':
+	unittest.main()
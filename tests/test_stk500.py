@@ -0,0 +1,145 @@
+"""
+The STK500v1 uploader, against the simulated bootloader on a pty.
+
+	python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from sconsduino import elf, stk500
+
+MCU = 'atmega328p'
+
+class Uploads(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.sims = []
+
+	def tearDown(self):
+		for s in self.sims:
+			s.close()
+		shutil.rmtree(self.dir)
+
+	def simulate(self, mcu=MCU, **kw):
+		s = stk500.Simulator(mcu, **kw)
+		self.sims.append(s)
+		return s
+
+	def hexfile(self, data, addr=0, name='sketch.hex'):
+		path = os.path.join(self.dir, name)
+		with open(path, 'w') as f:
+			f.write(elf.ihex([(addr, bytearray(data))]))
+		return path
+
+	def upload(self, sim, hexfile, mcu=MCU, bauds=(115200,), **kw):
+		return stk500.upload(sim.port, mcu, hexfile, list(bauds), **kw)
+
+class Sync(Uploads):
+	def test_first_baud_that_answers(self):
+		sim = self.simulate(bauds=(57600,))
+		r = self.upload(sim, self.hexfile(range(16)), bauds=(115200, 57600, 19200))
+		self.assertEqual(r['baud'], 57600)
+
+	def test_no_answer(self):
+		sim = self.simulate(bauds=(19200,))
+		with self.assertRaises(stk500.UploadError):
+			self.upload(sim, self.hexfile(range(16)), bauds=(115200, 57600))
+
+class Flash(Uploads):
+	def test_written_and_verified(self):
+		sim = self.simulate()
+		data = bytearray(i & 0xFF for i in range(300))
+		r = self.upload(sim, self.hexfile(data, 0x100))
+		self.assertEqual(sim.flash[0x100:0x100+len(data)], data)
+		# 0x100-0x22b spans three 128 byte pages
+		self.assertEqual((r['pages'], r['total_pages'], r['bytes']), (3, 3, 300))
+
+	def test_verify_mismatch(self):
+		sim = self.simulate()
+		p = stk500.Programmer.connect(sim.port, MCU, [115200])
+		try:
+			page = bytearray(range(128))
+			p.write_pages({0: page})
+			sim.flash[5] ^= 0xFF
+			with self.assertRaises(stk500.UploadError):
+				p.verify_pages({0: page})
+		finally:
+			p.close()
+
+	def test_signature_mismatch(self):
+		sim = self.simulate('atmega168')
+		with self.assertRaises(stk500.UploadError):
+			self.upload(sim, self.hexfile(range(16)))
+		self.assertEqual(sim.pages_written, 0)
+
+	def test_too_big(self):
+		sim = self.simulate()
+		with self.assertRaises(stk500.UploadError):
+			self.upload(sim, self.hexfile(range(16), 32768 - 8))
+
+class Incremental(Uploads):
+	def setUp(self):
+		super(Incremental, self).setUp()
+		self.state = os.path.join(self.dir, 'state.json')
+		self.data = bytearray(i & 0xFF for i in range(128 * 10))
+
+	def test_only_changed_pages(self):
+		sim = self.simulate()
+		r = self.upload(sim, self.hexfile(self.data), state=self.state)
+		self.assertEqual(r['pages'], 10)
+		self.data[128 * 7 + 3] ^= 0xFF
+		r = self.upload(sim, self.hexfile(self.data), state=self.state)
+		self.assertEqual((r['pages'], r['total_pages']), (1, 10))
+		self.assertEqual(sim.pages_written, 11)
+		self.assertEqual(sim.flash[:len(self.data)], self.data)
+
+	def test_unchanged(self):
+		sim = self.simulate()
+		self.upload(sim, self.hexfile(self.data), state=self.state)
+		r = self.upload(sim, self.hexfile(self.data), state=self.state)
+		self.assertEqual(r['pages'], 0)
+
+	def test_flashed_some_other_way(self):
+		sim = self.simulate()
+		self.upload(sim, self.hexfile(self.data), state=self.state)
+		sim.flash[:] = bytearray([0xFF] * len(sim.flash))
+		self.data[0] ^= 0xFF
+		r = self.upload(sim, self.hexfile(self.data), state=self.state)
+		self.assertEqual(r['pages'], 10)
+		self.assertEqual(sim.flash[:len(self.data)], self.data)
+
+	def test_erase_writes_everything(self):
+		sim = self.simulate()
+		self.upload(sim, self.hexfile(self.data), state=self.state)
+		r = self.upload(sim, self.hexfile(self.data), state=self.state, erase=True)
+		self.assertEqual(r['pages'], 10)
+
+class Fuses(Uploads):
+	def test_only_differing_fuses_written(self):
+		sim = self.simulate(fuses=(0xFF, 0xDA, 0x05))
+		hexfile = self.hexfile(range(16))
+		r = self.upload(sim, hexfile, erase=True, fuses=(0xE2, 0xDA, 0x05), reset=False)
+		self.assertEqual(r['fuses'], 1)
+		self.assertEqual(sim.fuses['lfuse'], 0xE2)
+		self.assertEqual(sim.fuse_writes, 1)
+
+	def test_set_fuses_skipped(self):
+		sim = self.simulate(fuses=(0xE2, 0xDA, 0x05))
+		hexfile = self.hexfile(range(16))
+		for i in range(2):
+			r = self.upload(sim, hexfile, erase=True, fuses=(0xE2, 0xDA, 0x05), reset=False)
+			self.assertEqual(r['fuses'], 0)
+		self.assertEqual(sim.fuse_writes, 0)
+
+	def test_unused_fuse_bits(self):
+		# A 328P reads an efuse of 0x05 back as 0xFD
+		sim = self.simulate(fuses=(0xFF, 0xDA, 0x04))
+		hexfile = self.hexfile(range(16))
+		r = self.upload(sim, hexfile, erase=True, fuses=(0xFF, 0xDA, 0x05), reset=False)
+		self.assertEqual(r['fuses'], 1)
+		r = self.upload(sim, hexfile, erase=True, fuses=(0xFF, 0xDA, 0x05), reset=False)
+		self.assertEqual(r['fuses'], 0)
+
+if __name__ == '__main__':
+	unittest.main()